@@ -0,0 +1,110 @@
+#!/usr/bin/env python2
+"""
+Measure how long git-got takes to start up, for commands that never touch
+the network.  Git hooks may run git-got many times, so this is mostly the
+cost of the imports.
+
+Run it from anywhere:
+
+    python bench/startup.py [-n RUNS] [--max-ms MS]
+
+It exits with an error if importing git_got loads one of the backend
+libraries, or if the median run of a command takes longer than --max-ms.
+"""
+
+from __future__ import print_function
+
+import sys
+import os
+import getopt
+import shutil
+import subprocess
+import tempfile
+import time
+
+GIT_GOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'git_got.py')
+
+# The libraries the remotes use, which only the commands that connect to a
+# remote should import
+BACKEND_MODULES = ('paramiko', 'requests', 'requests_toolbelt', 'ftplib')
+
+COMMANDS = (['list_remotes'], ['status'])
+
+def run(args, cwd):
+    """
+    @param args  The git-got arguments
+    @param cwd   The directory to run git-got in
+    @return How long git-got took, in seconds
+    """
+    with open(os.devnull, 'wb') as devnull:
+        start = time.time()
+        subprocess.check_call([sys.executable, GIT_GOT] + args, cwd=cwd,
+                              stdout=devnull)
+        return time.time() - start
+
+def backend_imports():
+    """
+    @return The backend libraries that importing git_got loads
+    """
+    script = ('import sys; sys.path.insert(0, %r); import git_got; '
+              'print(" ".join(m for m in %r if sys.modules.get(m)))'
+              % (os.path.dirname(GIT_GOT), BACKEND_MODULES))
+    return subprocess.check_output([sys.executable, '-c', script]).split()
+
+def make_repo(path):
+    """
+    Set up a repository with a got remote and a tracked file.
+
+    @param path  Where to create the repository
+    """
+    with open(os.devnull, 'wb') as devnull:
+        subprocess.check_call(['git', 'init', '-q', path])
+        subprocess.check_call(['git', 'config', 'user.email', 'bench@example.com'], cwd=path)
+        subprocess.check_call(['git', 'config', 'user.name', 'bench'], cwd=path)
+        store = os.path.join(path, '..', 'store')
+        os.mkdir(store)
+        subprocess.check_call([sys.executable, GIT_GOT, 'init', 'origin', 'file',
+                               'file://' + os.path.abspath(store)], cwd=path,
+                              stdout=devnull)
+        with open(os.path.join(path, 'data'), 'wb') as fp:
+            fp.write(os.urandom(65536))
+        subprocess.check_call([sys.executable, GIT_GOT, 'add', 'data'], cwd=path,
+                              stdout=devnull)
+
+def main():
+    (opts, args) = getopt.getopt(sys.argv[1:], 'n:', ['max-ms='])
+    runs = 10
+    max_ms = None
+    for (opt, value) in opts:
+        if opt == '-n':
+            runs = int(value)
+        elif opt == '--max-ms':
+            max_ms = float(value)
+
+    failed = False
+    loaded = backend_imports()
+    if loaded:
+        print('importing git_got loads %s' % ', '.join(loaded))
+        failed = True
+
+    tmpdir = tempfile.mkdtemp(prefix='git-got-bench-')
+    try:
+        repo = os.path.join(tmpdir, 'repo')
+        make_repo(repo)
+        for args in COMMANDS:
+            # the first run warms up the page cache and the .pyc files
+            run(args, repo)
+            times = sorted(run(args, repo) for i in xrange(runs))
+            median_ms = times[len(times) / 2] * 1000
+            print('%-14s median %6.1f ms  min %6.1f ms  (%d runs)'
+                  % (' '.join(args), median_ms, times[0] * 1000, runs))
+            if max_ms is not None and median_ms > max_ms:
+                print('%s is slower than %.1f ms' % (' '.join(args), max_ms))
+                failed = True
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
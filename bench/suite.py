@@ -0,0 +1,296 @@
+#!/usr/bin/env python2
+"""
+Benchmark git-got on synthetic repositories against local servers.
+
+For each backend and each repository shape, a fresh repository and remote
+are set up, and these are timed, in order:
+
+  add               add -R of the whole tree, to an empty remote
+  status            status, with the hashes known from the add
+  get               get into an empty working tree with an empty local cache
+  get-cached        get into an empty working tree from the local cache
+  fill-local-cache  fill-local-cache into an empty local cache
+
+The backends are 'file', and 'scp', 'srr' and 'ftp' against the stand-ins in
+servers.py ('ftp' needs pyftpdlib).  'scp-rename' is scp against an SFTP
+server without the posix-rename extension, where uploads fall back to a plain
+rename.  The repository shapes are:
+
+  small   many small files
+  large   a few large files
+  mixed   some of both, and files in between
+
+The files are generated from a fixed seed, so that every run moves the same
+data.  Everything runs in a scratch directory, with HOME pointing into it, so
+that neither the user's local cache nor their settings are involved.
+
+    python bench/suite.py [-b BACKENDS] [-s SHAPES] [-j JOBS] [-r REPEAT]
+                          [--scale FACTOR] [-o FILE]
+
+The results are written as JSON to FILE (or to stdout), and a summary to
+stderr.
+"""
+
+from __future__ import print_function
+
+import sys
+import os
+import getopt
+import json
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+import paramiko
+
+import servers
+
+GIT_GOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'git_got.py')
+
+BACKENDS = ('file', 'scp', 'scp-rename', 'srr', 'ftp')
+
+# shape -> list of (number of files, size of each file); the sizes are scaled
+# by --scale
+SHAPES = {
+    'small': [(1000, 4096)],
+    'large': [(3, 64 * 1048576)],
+    'mixed': [(200, 4096), (20, 1048576), (2, 32 * 1048576)],
+}
+
+OPERATIONS = ('add', 'status', 'get', 'get-cached', 'fill-local-cache')
+
+SEED = 4679
+BLOCK_SIZE = 1048576
+
+def make_tree(path, shape, scale):
+    """
+    Generate the files of a repository shape.  Every file, and every block of
+    each file, is different, so that no object is stored twice.
+
+    @param path   The directory to create the files in
+    @param shape  The name of the shape, from SHAPES
+    @param scale  What to multiply the file sizes by
+    @return The number of files and their total size
+    """
+    rand = random.Random(SEED)
+    block = ('%0*x' % (BLOCK_SIZE * 2, rand.getrandbits(BLOCK_SIZE * 8))).decode('hex')
+    files = 0
+    total = 0
+    for (group, (count, size)) in enumerate(SHAPES[shape]):
+        size = max(1, int(size * scale))
+        directory = os.path.join(path, 'g%d' % group)
+        os.makedirs(directory)
+        for i in xrange(count):
+            # a few directories rather than thousands of files in one
+            subdir = os.path.join(directory, 'd%02d' % (i % 16))
+            if not os.path.isdir(subdir):
+                os.mkdir(subdir)
+            with open(os.path.join(subdir, 'f%05d' % i), 'wb') as fp:
+                left = size
+                offset = 0
+                while left > 0:
+                    header = '%s:%d:%d:%d\n' % (shape, group, i, offset)
+                    chunk = (header + block[len(header):])[:left]
+                    fp.write(chunk)
+                    left -= len(chunk)
+                    offset += len(chunk)
+            files += 1
+            total += size
+    return (files, total)
+
+class Bench(object):
+    """
+    Runs git-got in a scratch directory, with its own HOME.
+    """
+    def __init__(self, workdir):
+        self.workdir = workdir
+        self.home = os.path.join(workdir, 'home')
+        os.mkdir(self.home)
+        # the SCP backend logs in with the user's key and records host keys
+        ssh_dir = os.path.join(self.home, '.ssh')
+        os.mkdir(ssh_dir)
+        paramiko.RSAKey.generate(2048).write_private_key_file(os.path.join(ssh_dir, 'id_rsa'))
+        open(os.path.join(ssh_dir, 'known_hosts'), 'w').close()
+        self.env = dict(os.environ)
+        self.env['HOME'] = self.home
+        self.env.pop('SSH_AUTH_SOCK', None)
+        self.env['PYTHONWARNINGS'] = 'ignore'
+        self.env['GIT_CONFIG_NOSYSTEM'] = '1'
+        with open(os.path.join(self.home, '.gitconfig'), 'w') as fp:
+            fp.write('[user]\n\tname = bench\n\temail = bench@example.com\n')
+
+    def git(self, repo, *args):
+        with open(os.devnull, 'wb') as devnull:
+            subprocess.check_call(['git'] + list(args), cwd=repo, env=self.env,
+                                  stdout=devnull)
+
+    def got(self, repo, *args):
+        """
+        @return How long git-got took, in seconds
+        """
+        with open(os.devnull, 'wb') as devnull:
+            start = time.time()
+            subprocess.check_call([sys.executable, GIT_GOT] + list(args), cwd=repo,
+                                  env=self.env, stdout=devnull)
+            return time.time() - start
+
+    def clear_cache(self, repo):
+        self.got(repo, 'clear-local-cache')
+
+def start_server(backend, root):
+    """
+    @param backend  The name of the backend
+    @param root     The directory for the server to keep its data in
+    @return The server, or None for the file backend, the type of the remote
+            and its URL
+    """
+    if backend == 'file':
+        return (None, 'file', 'file://' + root)
+    if backend == 'scp':
+        server = servers.SFTPServer(root)
+    elif backend == 'scp-rename':
+        server = servers.SFTPServer(root, posix_rename=False)
+    elif backend == 'srr':
+        server = servers.SRRServer(root)
+    elif backend == 'ftp':
+        server = servers.FTPServer(root)
+    return (server, backend.split('-')[0], server.url())
+
+def run_once(bench, backend, shape, tree, jobs):
+    """
+    Run the operations once, on a new repository and remote.
+
+    @return A dict of how long each operation took, in seconds
+    """
+    base = tempfile.mkdtemp(prefix='%s-%s-' % (backend, shape), dir=bench.workdir)
+    remote_root = os.path.join(base, 'remote')
+    os.mkdir(remote_root)
+    repo = os.path.join(base, 'repo')
+    (server, remote_type, url) = start_server(backend, remote_root)
+    try:
+        os.mkdir(repo)
+        bench.git(repo, 'init', '-q', '.')
+        bench.got(repo, 'init', 'origin', remote_type, url)
+        shutil.copytree(tree, os.path.join(repo, 'data'))
+        bench.clear_cache(repo)
+
+        times = {}
+        times['add'] = bench.got(repo, 'add', '-R', '-j', str(jobs), 'data')
+        bench.git(repo, 'commit', '-q', '-m', 'bench')
+        times['status'] = bench.got(repo, 'status', '-j', str(jobs))
+
+        bench.got(repo, 'rm_local')
+        bench.clear_cache(repo)
+        times['get'] = bench.got(repo, 'get', '-j', str(jobs))
+
+        bench.got(repo, 'rm_local')
+        times['get-cached'] = bench.got(repo, 'get', '-j', str(jobs))
+
+        bench.clear_cache(repo)
+        times['fill-local-cache'] = bench.got(repo, 'fill-local-cache', '-j', str(jobs))
+        return times
+    finally:
+        if server is not None:
+            server.stop()
+        shutil.rmtree(base, ignore_errors=True)
+
+def git_got_revision():
+    try:
+        with open(os.devnull, 'wb') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                           cwd=os.path.dirname(GIT_GOT),
+                                           stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    (opts, args) = getopt.getopt(sys.argv[1:], 'b:s:j:r:o:', ['scale='])
+    backends = list(BACKENDS)
+    shapes = sorted(SHAPES)
+    jobs = 4
+    repeat = 3
+    scale = 1.0
+    output = None
+    for (opt, value) in opts:
+        if opt == '-b':
+            backends = value.split(',')
+        elif opt == '-s':
+            shapes = value.split(',')
+        elif opt == '-j':
+            jobs = int(value)
+        elif opt == '-r':
+            repeat = int(value)
+        elif opt == '--scale':
+            scale = float(value)
+        elif opt == '-o':
+            output = value
+    for backend in backends:
+        if backend not in BACKENDS:
+            raise SystemExit("unknown backend '%s'" % backend)
+    for shape in shapes:
+        if shape not in SHAPES:
+            raise SystemExit("unknown repository shape '%s'" % shape)
+    if 'ftp' in backends:
+        try:
+            import pyftpdlib
+        except ImportError:
+            print('pyftpdlib is not installed; skipping the ftp backend', file=sys.stderr)
+            backends.remove('ftp')
+
+    workdir = tempfile.mkdtemp(prefix='git-got-bench-')
+    results = []
+    try:
+        bench = Bench(workdir)
+        for shape in shapes:
+            tree = os.path.join(workdir, 'tree-%s' % shape)
+            os.mkdir(tree)
+            (files, size) = make_tree(tree, shape, scale)
+            for backend in backends:
+                runs = [run_once(bench, backend, shape, tree, jobs) for i in xrange(repeat)]
+                for operation in OPERATIONS:
+                    seconds = sorted(run[operation] for run in runs)
+                    median = seconds[len(seconds) / 2]
+                    result = {
+                        'backend': backend,
+                        'shape': shape,
+                        'operation': operation,
+                        'files': files,
+                        'bytes': size,
+                        'jobs': jobs,
+                        'seconds': seconds,
+                        'median_seconds': median,
+                        'bytes_per_second': size / median if median > 0 else None,
+                        'ms_per_file': median * 1000 / files,
+                    }
+                    results.append(result)
+                    print('%-10s %-6s %-17s %8.2f s %9.1f MB/s %8.2f ms/file'
+                          % (backend, shape, operation, median,
+                             size / median / 1048576 if median > 0 else 0,
+                             result['ms_per_file']), file=sys.stderr)
+            shutil.rmtree(tree)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'version': 1,
+        'git_got_revision': git_got_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'scale': scale,
+        'repeat': repeat,
+        'results': results,
+    }
+    if output is None:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        with open(output, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
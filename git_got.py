@@ -36,49 +36,343 @@ import os
 import hashlib
 import json
 import fnmatch
-import requests
-import dulwich.porcelain
+import dulwich.repo
+import dulwich.index
+import dulwich.object_store
 import errno
-import requests_toolbelt.multipart.encoder
 import re
-import paramiko
 import urlparse
 import getpass
 import getopt
 import logging
-import ftplib
 import collections
+import bisect
 import contextlib
 import urllib
 import shutil
+import multiprocessing.pool
+import threading
+import Queue
+import socket
+import stat
+import time
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows; reflinks are then never attempted
+    fcntl = None
+
+class LazyModule(object):
+    """
+    Stands in for a module that is only imported the first time one of its
+    attributes is used.  The backends' libraries take most of the startup time,
+    and most commands never connect to a remote.
+    """
+    def __init__(self, name):
+        """
+        @param name  The module to import, which may be a submodule; the
+                     attributes are looked up on its top-level package, as
+                     after a plain "import name"
+        """
+        self._lazy_name = name
+        self._lazy_module = None
+
+    def __getattr__(self, attr):
+        # only called for what the proxy itself doesn't have
+        if self._lazy_module is None:
+            self._lazy_module = __import__(self._lazy_name)
+        return getattr(self._lazy_module, attr)
+
+paramiko = LazyModule('paramiko')
+requests = LazyModule('requests')
+requests_toolbelt = LazyModule('requests_toolbelt.multipart.encoder')
+ftplib = LazyModule('ftplib')
 
 VERSION = 1
 
 remote_objs = []
 
+# How much of a file to hash at a time.  Large reads keep the interpreter
+# overhead per byte low on multi-GB files.
+HASH_BLOCK_SIZE = 1048576
+
 local_cache_path = os.path.expanduser('~/.git-got-cache')
 
+# How files are brought out of the local cache (set from the got.cacheLink git
+# configuration by load_settings()):
+#   copy      always copy the object
+#   reflink   share the blocks of the object (copy-on-write) where the
+#             filesystem supports it, otherwise copy
+#   hardlink  like reflink, but fall back to a hard link, otherwise copy.
+#             Hard linked files are made read-only so that they cannot be
+#             modified in place, which would modify the cached object too.
+CACHE_LINK_MODES = ('copy', 'reflink', 'hardlink')
+cache_link_mode = 'reflink'
+
+# What the stamp file recording when another user last used a cached object
+# is named after the object (see mark_cache_object_used())
+USED_SUFFIX = '.used'
+
+# The FICLONE ioctl from <linux/fs.h>
+FICLONE = 0x40049409
+
+# The most the local cache may hold, in bytes, or None for no limit; and how
+# full, in percent of that, cache_gc() leaves it (set from the
+# got.cacheMaxSize and got.cacheLowWatermark git configuration by
+# load_settings())
+cache_max_size = None
+cache_low_watermark = 80
+
+# Whether this command added anything to the local cache
+cache_grown = False
+
+# Objects of at least segment_threshold bytes are transferred in
+# transfer_segments pieces at the same time (downloads from HTTP remotes that
+# allow it, uploads over SCP), as a single stream rarely fills a fast
+# long-distance link (set from the got.segmentThreshold and got.segments git
+# configuration by load_settings())
+segment_threshold = 64 * 1048576
+transfer_segments = 4
+
+# Whether add hashes files as they are uploaded, reading them only once, to
+# remotes that can rename uploads; the remote can then not be asked whether
+# it has a file before the file is uploaded (set from the got.hashOnUpload git
+# configuration by load_settings())
+hash_on_upload = False
+
+# Where downloads are kept while they are incomplete, so that they can be
+# resumed (set by _main() to a directory in the git directory), or None to
+# always download from the start
+partial_dir = None
+
+# How long, in seconds, an incomplete download is kept without being resumed
+# before partial_gc() gives up on it
+PARTIAL_MAX_AGE = 7 * 86400
+
+############################## PROFILING #####################################
+class Profiler(object):
+    """
+    Timers and counters for the phases of a command (walking the tree,
+    hashing, transfers, the cache, the git index...), enabled with --profile.
+    A phase is timed with span() or the profiled() decorator.  At the end,
+    summary() gives a table of where the time went, and trace() a JSON trace
+    in the Chrome trace event format, which chrome://tracing and Perfetto
+    can show.  While disabled, timing a phase costs a single test.
+    """
+    class _NoSpan(object):
+        def __enter__(self):
+            pass
+        def __exit__(self, *exc_info):
+            return False
+
+    NO_SPAN = _NoSpan()
+
+    def __init__(self):
+        self.enabled = False
+        self.start = time.time()
+        self.lock = threading.Lock()
+        # (name, start, duration, thread id, args) of every span
+        self.events = []
+        # name -> [calls, total seconds, longest call]
+        self.totals = {}
+        self.counters = {}
+
+    def enable(self):
+        self.enabled = True
+        self.start = time.time()
+
+    def span(self, name, **args):
+        """
+        @param name  The name of the phase
+        @param args  Details to record in the trace, e.g. the filename
+        @return A context manager timing what runs inside it
+        """
+        if not self.enabled:
+            return self.NO_SPAN
+        return self._span(name, args)
+
+    @contextlib.contextmanager
+    def _span(self, name, args):
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            with self.lock:
+                self.events.append((name, start, duration,
+                                    threading.current_thread().ident, args))
+                total = self.totals.get(name)
+                if total is None:
+                    self.totals[name] = [1, duration, duration]
+                else:
+                    total[0] += 1
+                    total[1] += duration
+                    total[2] = max(total[2], duration)
+
+    def count(self, name, n=1):
+        """
+        @param name  The name of the counter
+        @param n     How much to add to it
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        """
+        @return A table of the calls and the time of every phase, the
+                slowest first, and of the counters
+        """
+        lines = ["%-24s %8s %10s %10s %10s" % ("phase", "calls", "total s", "mean ms", "max ms")]
+        lines.append("%-24s %8d %10.3f" % ("(wall time)", 1, time.time() - self.start))
+        with self.lock:
+            for (name, (calls, total, longest)) in sorted(self.totals.iteritems(),
+                                                          key=lambda item: -item[1][1]):
+                lines.append("%-24s %8d %10.3f %10.2f %10.2f" % (name, calls, total,
+                                                                total * 1000 / calls,
+                                                                longest * 1000))
+            if len(self.counters) != 0:
+                lines.append("")
+                lines.append("%-24s %8s" % ("counter", "value"))
+                for (name, value) in sorted(self.counters.iteritems()):
+                    lines.append("%-24s %8d" % (name, value))
+        return "\n".join(lines)
+
+    def trace(self):
+        """
+        @return The spans and counters, as a Chrome trace event format object
+        """
+        pid = os.getpid()
+        with self.lock:
+            events = [{'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                       'ts': int((start - self.start) * 1000000),
+                       'dur': int(duration * 1000000), 'args': args}
+                      for (name, start, duration, tid, args) in self.events]
+            counters = dict(self.counters)
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': {'counters': counters}}
+
+profiler = Profiler()
+
+def profiled(name):
+    """
+    A decorator timing every call of the function as the phase name (see
+    Profiler).
+
+    @param name  The name of the phase
+    """
+    def decorator(fn):
+        def wrapped(*args, **kwargs):
+            if not profiler.enabled:
+                return fn(*args, **kwargs)
+            with profiler._span(name, {}):
+                return fn(*args, **kwargs)
+        wrapped.__name__ = fn.__name__
+        wrapped.__doc__ = fn.__doc__
+        return wrapped
+    return decorator
+
 def load_with_cache(fn):
+    # The wrapped backend function gets a VerifyingWriter to write the object
+    # into, instead of the filename; the writer checks the object against its
+    # checksum and fills the local cache as the data arrives.  A download that
+    # fails is kept as a partial object, which the backend function continues
+    # from (at writer.offset) the next time.
     def wrapped(self, filename, checksum, force, *args, **kwargs):
         if not self:
             return fn(self, *args, **kwargs)
         if self.load_from_cache(filename, checksum, force):
             return
-        fn(self, filename, checksum, *args, **kwargs)
-        self.store_in_cache(filename, checksum)
+
+        def load(partial):
+            writer = VerifyingWriter(filename, checksum,
+                                     self.generate_path_for_cache(checksum),
+                                     partial)
+            try:
+                fn(self, writer, checksum, *args, **kwargs)
+            except:
+                writer.abort()
+                raise
+            try:
+                writer.commit()
+            except ChecksumMismatch:
+                if writer.resumed == 0:
+                    raise
+                # whatever was wrong may have been in the part kept from
+                # before; commit() threw that away, so try once more from
+                # scratch
+                logging.warning("Resumed download of '%s' was corrupt; downloading it again" % filename)
+                load(partial)
+                return
+            usage_stats.add('download_objects', 1, self.remote_name())
+            usage_stats.add('download_bytes', writer.offset - writer.resumed, self.remote_name())
+
+        partial = partial_object_path(checksum)
+        try:
+            with profiler.span('remote.load', file=filename):
+                if partial is None:
+                    load(None)
+                else:
+                    # several files may share an object; only one of them can
+                    # be writing to its partial object at a time
+                    with file_lock(partial + '.lock'):
+                        # whoever held the lock before us may have just
+                        # downloaded the object into the cache
+                        if (os.path.isfile(self.generate_path_for_cache(checksum)) and
+                            self.load_from_cache(filename, checksum, force)):
+                            return
+                        load(partial)
+        except:
+            progress.done(filename, ok=False)
+            raise
+        progress.done(filename)
     return wrapped
 
 def store_with_cache(fn):
+    # The wrapped backend function gets an UploadSource to read the file from,
+    # instead of the filename; the source checks the data against its checksum
+    # and fills the local cache as the upload reads it.  Objects the remote
+    # already has are not uploaded again.
     def wrapped(self, filename, checksum, *args, **kwargs):
         if not self:
             return fn(self, *args, **kwargs)
-        fn(self, filename, checksum, *args, **kwargs)
-        self.store_in_cache(filename, checksum)
+        if self.exists(checksum):
+            logging.debug("File existed on remote, skipping upload...")
+            usage_stats.add('upload_skipped_objects', 1, self.remote_name())
+            usage_stats.add('upload_skipped_bytes', os.path.getsize(filename), self.remote_name())
+            self.store_in_cache(filename, checksum)
+            return
+        logging.debug("Uploading file to remote...")
+        source = UploadSource(filename,
+                              not os.path.isfile(cache_object_path(checksum)))
+        try:
+            with profiler.span('remote.store', file=filename):
+                ret = fn(self, source, checksum, *args, **kwargs)
+        except:
+            source.close()
+            progress.done(filename, ok=False)
+            raise
+        source.close(checksum)
+        progress.done(filename)
+        usage_stats.add('upload_objects', 1, self.remote_name())
+        usage_stats.add('upload_bytes', source.size, self.remote_name())
+        self.present[checksum] = True
+        return ret
     return wrapped
 
 class Remote(object):
+    # Whether the backend can upload under a temporary name and rename the
+    # upload into place (see _put(), _rename() and _delete()).  Such backends
+    # get store() for free, and can store files whose checksum isn't known yet
+    # with store_unhashed().
+    can_rename = False
+
     def __init__(self, configuration):
         self.configuration = configuration
+        # what we have learnt about which objects the remote has, keyed by
+        # checksum
+        self.present = {}
 
     def version(self):
         return self.configuration['version']
@@ -99,9 +393,9 @@ class Remote(object):
         raise Exception("Load not implemented for this remote!")
 
     def generate_path_for_cache(self, checksum):
-        checksum = checksum.encode('utf-8').lower()
-        return os.path.join(local_cache_path, checksum[0], checksum[1:])
+        return cache_object_path(checksum)
 
+    @profiled('cache.load')
     def load_from_cache(self, filename, checksum, force):
         '''
         Try loading the given file from cache instead of getting from the remote
@@ -113,6 +407,7 @@ class Remote(object):
         if force:
             return False
 
+        usage_stats.add('cache_lookups', 1)
         path = self.generate_path_for_cache(checksum)
         logging.debug('checking for file in cache: %s', path)
         if not os.path.isfile(path):
@@ -120,22 +415,183 @@ class Remote(object):
             return False
 
         logging.debug('retrieving file from cache')
-        size = os.path.getsize(path)
 
         try:
-            copy_file(path, filename, "Downloading (cached)", filename)
+            # Objects hard linked into working trees are never evicted, and
+            # touching them would make every working copy look modified, so
+            # they are left alone.
+            if os.stat(path).st_nlink == 1:
+                mark_cache_object_used(path)
+        except OSError as e:
+            logging.debug('Failed to mark %s as used: %s' % (path, e))
+
+        try:
+            if link_file(path, filename, cache_link_mode):
+                size = os.path.getsize(filename)
+                print_transfer_string(size, size, filename, "Downloading (cached)")
+                progress.done(filename)
+                profiler.count('cache.hits')
+                usage_stats.add('cache_hits', 1)
+                usage_stats.add('cache_hit_bytes', size)
+                return True
+
+            # copying reads the whole object anyway, so check it on the way
+            writer = VerifyingWriter(filename, checksum)
+            try:
+                with open(path, 'rb') as src:
+                    size = file_length(src)
+                    copy_stream(src, writer, size, "Downloading (cached)",
+                                filename)
+            except:
+                writer.abort()
+                progress.done(filename, ok=False)
+                raise
+            try:
+                writer.commit()
+            except ChecksumMismatch as e:
+                progress.done(filename, ok=False)
+                logging.warning('Removing corrupt object %s from the cache: %s' % (path, e))
+                os.remove(path)
+                return False
+            progress.done(filename)
+            profiler.count('cache.hits')
+            usage_stats.add('cache_hits', 1)
+            usage_stats.add('cache_hit_bytes', size)
             return True
         except Exception, e:
             logging.exception('Failed retrieving from cache', e)
         return False
 
-    def store(self, filename, checksum):
-        raise Exception("Store not implemented for this remote!")
+    @store_with_cache
+    def store(self, source, checksum):
+        if not self.can_rename:
+            raise Exception("Store not implemented for this remote!")
+
+        # Upload under a temporary name, so that an interrupted upload never
+        # leaves a truncated object behind under its real name.
+        tmpname = upload_temp_name()
+        try:
+            self._put(source, tmpname)
+            # the file may have changed since it was hashed
+            source.check(checksum)
+            self._rename(tmpname, '%s.got' % (checksum))
+        except:
+            self._delete_quietly(tmpname)
+            raise
+
+    def store_unhashed(self, filename):
+        '''
+        Store a file whose checksum isn't known yet.  The file is hashed (and
+        copied into the local cache) from the same read that uploads it, under
+        a temporary name; once the checksum is known, the upload is renamed
+        into place, or thrown away if the remote turns out to have the object
+        already.  Only for backends that can_rename.
+
+        filename: local path
+        returns: the checksum of the file
+        '''
+        source = UploadSource(filename)
+        tmpname = upload_temp_name()
+        try:
+            try:
+                with profiler.span('remote.store', file=filename):
+                    self._put(source, tmpname)
+                checksum = source.hexdigest()
+                uploaded = not self.exists(checksum)
+                if not uploaded:
+                    logging.debug("File existed on remote, dropping upload...")
+                    self._delete(tmpname)
+                else:
+                    self._rename(tmpname, '%s.got' % (checksum))
+                    self.present[checksum] = True
+            except:
+                self._delete_quietly(tmpname)
+                raise
+        except:
+            source.close()
+            progress.done(filename, ok=False)
+            raise
+        source.close(checksum)
+        progress.done(filename)
+        if uploaded:
+            usage_stats.add('upload_objects', 1, self.remote_name())
+            usage_stats.add('upload_bytes', source.size, self.remote_name())
+        else:
+            # sent all the same, but the remote would not have needed it
+            usage_stats.add('upload_skipped_objects', 1, self.remote_name())
+            usage_stats.add('upload_skipped_bytes', source.size, self.remote_name())
+        return checksum
+
+    def _put(self, source, remotefile):
+        '''
+        Upload everything read from source to remotefile.
+
+        source: UploadSource to read the data from
+        remotefile: name of the object on the remote
+        '''
+        raise Exception("Put not implemented for this remote!")
+
+    def _rename(self, oldname, newname):
+        raise Exception("Rename not implemented for this remote!")
+
+    def _delete(self, remotefile):
+        raise Exception("Delete not implemented for this remote!")
+
+    def _delete_quietly(self, remotefile):
+        try:
+            self._delete(remotefile)
+        except Exception as e:
+            logging.debug("Failed to remove '%s' from the remote: %s" % (remotefile, e))
+
+    @profiled('remote.exists')
+    def exists(self, checksum):
+        '''
+        Whether the remote already has the object with the given checksum.
+        Answers found by an earlier exists() or exists_many() are reused.
+
+        checksum: checksum of the object
+        '''
+        known = self.present.get(checksum)
+        if known is None:
+            known = self._exists(checksum)
+            self.present[checksum] = known
+        return known
+
+    @profiled('remote.exists_many')
+    def exists_many(self, checksums, jobs=1):
+        '''
+        Find out in bulk which of the given objects the remote already has.
+        Later calls to exists() for these checksums are then answered without
+        asking the remote again.
+
+        checksums: list of checksums of the objects
+        jobs: how many requests the remote may make at the same time
+        returns: the set of the checksums the remote has
+        '''
+        unknown = [c for c in set(checksums) if c not in self.present]
+        if len(unknown) != 0:
+            self.present.update(self._exists_many(unknown, jobs))
+        return set(c for c in checksums if self.present[c])
+
+    def _exists(self, checksum):
+        raise Exception("Exists not implemented for this remote!")
+
+    def _exists_many(self, checksums, jobs):
+        '''
+        Backends that can answer for many objects at once (a single directory
+        listing, concurrent requests...) override this.
+
+        returns: a dict mapping each checksum to whether the remote has it
+        '''
+        return dict((c, self._exists(c)) for c in checksums)
 
     def store_in_cache(self, filename, checksum):
         '''
         Store the file in our local cache
 
+        The object is written under a temporary name and renamed into place
+        once complete (see install_cache_object()).
+
         filename: source filename
         checksum: checksum from file
         '''
@@ -145,92 +601,373 @@ class Remote(object):
             logging.debug('file already in our cache ignore cache updating')
             return False
 
-        parent = os.path.dirname(path)
-        if not os.path.isdir(parent):
-            try:
-                os.makedirs(parent)
-            except Exception, e:
-                logging.exception('Failed creating parent for cache', e)
-                return False
+        try:
+            cache_mkdir(os.path.dirname(path))
+        except Exception, e:
+            logging.exception('Failed creating parent for cache', e)
+            return False
 
         logging.debug('storing into our cache: %s' % checksum)
+        tmppath = temp_path(path)
         try:
-            shutil.copyfile(filename, path)
-            return True
+            # The working file stays writable, so it is never hard linked into
+            # the cache.
+            if not reflink_file(filename, tmppath):
+                shutil.copyfile(filename, tmppath)
+            return install_cache_object(tmppath, path)
         except Exception, e:
             logging.exception('Failed storing object into our cache', e)
+            try:
+                os.remove(tmppath)
+            except OSError:
+                pass
         return False
 
     def scheme(self):
         raise Exception("Scheme not implemented for this remote!")
 
+    def prepare_load(self, checksums, jobs):
+        '''
+        Called by get before any load(), with all of the objects it is going to
+        fetch from this remote, so that the remote can look them up in bulk.
+
+        checksums: list of the checksums that will be loaded
+        jobs: how many loads will run at the same time
+        '''
+        pass
+
+    def close(self):
+        '''
+        Release any connections held open to the remote.  Called once the
+        command is done with the remote.
+        '''
+        pass
+
+class SessionPool(object):
+    '''
+    A small pool of open connections to a remote, so that a command touching
+    many files pays for the connection setup once per parallel job instead of
+    once per file.
+    '''
+    def __init__(self, connect, is_alive, disconnect):
+        '''
+        connect: function returning a new session
+        is_alive: function telling whether an idle session is still usable
+        disconnect: function closing a session
+        '''
+        self.connect = connect
+        self.is_alive = is_alive
+        self.disconnect = disconnect
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                session = self.idle.pop()
+            if self.is_alive(session):
+                return session
+            logging.debug('dropping dead session')
+            self.discard(session)
+        return self.connect()
+
+    def release(self, session):
+        with self.lock:
+            self.idle.append(session)
+
+    def discard(self, session):
+        try:
+            self.disconnect(session)
+        except Exception:
+            pass
+
+    def run(self, operation, connection_errors):
+        '''
+        Run operation(session) on a pooled session.  If the session turns out to
+        be broken, it is thrown away and the operation is retried once on a
+        fresh one.
+
+        operation: function taking a session
+        connection_errors: tuple of the exceptions that mean the session broke
+        '''
+        retried = False
+        while True:
+            session = self.acquire()
+            try:
+                result = operation(session)
+            except connection_errors as e:
+                self.discard(session)
+                if retried:
+                    raise
+                logging.debug('session failed (%s), reconnecting' % e)
+                retried = True
+                continue
+            except:
+                self.release(session)
+                raise
+            self.release(session)
+            return result
+
+    def close(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for session in idle:
+            self.discard(session)
+
 ############################ SCP BACKEND #####################################
 class SCP(Remote):
+    can_rename = True
+
     def __init__(self, configuration):
         Remote.__init__(self, configuration)
-        self.direction = "Downloading"
-        self.filename = "Unset"
-
-    def _print_total(self, transferred, total):
-        print_transfer_string(transferred, total, self.filename, self.direction)
+        self.pool = SessionPool(self._ssh_sftp_connect,
+                                self._ssh_sftp_is_alive,
+                                self._ssh_sftp_disconnect)
+        # cleared once the server or paramiko turns out not to support the
+        # posix-rename extension
+        self.posix_rename = True
+
+    def _progress_cb(self, filename, direction):
+        # paramiko only hands us the byte counts, so bind the rest here; this
+        # keeps the callback free of shared state when transfers run in
+        # parallel
+        def cb(transferred, total):
+            print_transfer_string(transferred, total, filename, direction)
+        return cb
 
     def _get_location_info_scp(self):
         parser = urlparse.urlparse(self.configuration['remote'])
         username = parser.username
         if username is None:
             username = getpass.getuser()
-        return (parser.hostname, parser.path, username)
+        return (parser.hostname, parser.port or 22, parser.path, username)
 
+    @profiled('scp.connect')
     def _ssh_sftp_connect(self):
-        (hostname, remote_dir, username) = self._get_location_info_scp()
-        logging.debug("hostname: %s, remote_dir: %s, username: %s" % (hostname,
-                                                                      remote_dir,
-                                                                      username))
+        (hostname, port, remote_dir, username) = self._get_location_info_scp()
+        logging.debug("hostname: %s, port: %d, remote_dir: %s, username: %s" % (hostname,
+                                                                                 port,
+                                                                                 remote_dir,
+                                                                                 username))
         ssh = paramiko.SSHClient()
         ssh.load_host_keys(os.path.expanduser(os.path.join("~", ".ssh", "known_hosts")))
         ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(hostname, username=username)
+        ssh.connect(hostname, port=port, username=username)
         sftp = ssh.open_sftp()
         sftp.chdir(remote_dir)
         return (ssh, sftp)
 
+    def _ssh_sftp_is_alive(self, session):
+        transport = session[0].get_transport()
+        return transport is not None and transport.is_active()
+
+    def _ssh_sftp_disconnect(self, session):
+        (ssh, sftp) = session
+        sftp.close()
+        ssh.close()
+
+    @property
+    def connection_errors(self):
+        # what goes wrong when an SSH connection breaks
+        return (socket.error, EOFError, paramiko.SSHException)
+
+    def _run(self, operation):
+        '''
+        Run operation(sftp) on a pooled SFTP session, reconnecting if the session
+        has gone away.
+        '''
+        return self.pool.run(lambda session: operation(session[1]),
+                             self.connection_errors)
+
     @load_with_cache
-    def load(self, filename, checksum):
+    def load(self, writer, checksum):
         logging.debug("load_scp")
-        (ssh, sftp) = self._ssh_sftp_connect()
 
         remotefile = '%s.got' % (checksum)
-        self.direction = "Downloading"
-        self.filename = filename
-        sftp.get(remotefile, filename, callback=self._print_total)
-        sys.stdout.write("\n")
-        sftp.close()
-        ssh.close()
 
-    @store_with_cache
-    def store(self, filename, checksum):
+        def download(sftp):
+            # continues where the last attempt stopped, also when this is a
+            # retry on a new session
+            progress_cb = self._progress_cb(writer.filename, "Downloading")
+            with sftp.open(remotefile, 'rb') as src:
+                total = src.stat().st_size
+                if writer.offset > total:
+                    writer.restart()
+                src.seek(writer.offset)
+                src.prefetch(total)
+                while True:
+                    data = src.read(32768)
+                    if not data:
+                        break
+                    writer.write(data)
+                    progress_cb(writer.offset, total)
+            progress_cb(total, total)
+
+        self._run(download)
+
+    def _put(self, source, remotefile):
         logging.debug("store_scp")
-        (ssh, sftp) = self._ssh_sftp_connect()
 
-        remotefile = '%s.got' % (checksum)
+        if transfer_segments > 1 and source.size >= segment_threshold:
+            self.pool.run(lambda session: self._put_parallel(session, source, remotefile),
+                          self.connection_errors)
+            return
+
+        def upload(sftp):
+            # start over if this is a retry on a new session
+            source.restart()
+            sftp.putfo(source, remotefile, source.size,
+                       callback=self._progress_cb(source.filename, "Uploading"))
+
+        self._run(upload)
 
-        # here we do an optimization; if the remote file with the right filename
-        # already exists, we don't need to upload it again.  Just get out
+    def _put_parallel(self, session, source, remotefile):
+        '''
+        Upload a large file over several SFTP channels of the SSH connection at
+        the same time, as a single channel is held back by its window and by
+        waiting for the server to acknowledge each write.  The file is still
+        read (and hashed) once, in order; the blocks read are handed out to
+        the channels, which write them at their offsets in the remote file.
+
+        session: the pooled (ssh, sftp) session to upload on
+        source: UploadSource to read the data from
+        remotefile: name of the object on the remote
+        '''
+        (ssh, sftp) = session
+        # start over if this is a retry on a new session
+        source.restart()
+
+        clients = [sftp]
+        handles = []
         try:
-            sftp.stat(remotefile)
-            logging.debug("File existed on remote, skipping upload...")
-            sftp.close()
-            ssh.close()
-            return
-        except IOError:
-            logging.debug("Uploading file to remote...")
+            remote_dir = sftp.getcwd()
+            for i in xrange(transfer_segments - 1):
+                client = paramiko.SFTPClient.from_transport(ssh.get_transport())
+                clients.append(client)
+                client.chdir(remote_dir)
+            handles.append(sftp.open(remotefile, 'wb'))
+            for client in clients[1:]:
+                handles.append(client.open(remotefile, 'r+b'))
+            for handle in handles:
+                # don't wait for each write to be acknowledged; errors are
+                # reported when the handle is closed
+                handle.set_pipelined(True)
+
+            blocks = Queue.Queue(2 * len(handles))
+            lock = threading.Lock()
+            transferred = [0]
+            errors = []
+            progress_cb = self._progress_cb(source.filename, "Uploading")
+
+            def write_blocks(handle):
+                while True:
+                    block = blocks.get()
+                    if block is None:
+                        break
+                    if errors:
+                        # keep taking blocks so that the reader isn't stuck
+                        continue
+                    try:
+                        handle.seek(block[0])
+                        handle.write(block[1])
+                    except Exception as e:
+                        errors.append(e)
+                        continue
+                    with lock:
+                        transferred[0] += len(block[1])
+                        progress_cb(transferred[0], source.size)
+
+            writers = [threading.Thread(target=write_blocks, args=(handle,))
+                       for handle in handles]
+            for writer in writers:
+                writer.daemon = True
+                writer.start()
+            try:
+                offset = 0
+                while not errors:
+                    data = source.read(1048576)
+                    if not data:
+                        break
+                    blocks.put((offset, data))
+                    offset += len(data)
+            finally:
+                for writer in writers:
+                    blocks.put(None)
+                for writer in writers:
+                    writer.join()
+            if errors:
+                raise errors[0]
+
+            while handles:
+                handles.pop().close()
+            size = sftp.stat(remotefile).st_size
+            if size != source.size:
+                raise IOError("size mismatch in put!  %d != %d" % (size, source.size))
+        finally:
+            for handle in handles:
+                try:
+                    handle.close()
+                except Exception:
+                    pass
+            for client in clients[1:]:
+                client.close()
+
+    def _rename(self, oldname, newname):
+        def rename(sftp):
+            # unlike a plain SFTP rename, the posix-rename extension replaces
+            # an object someone else uploaded meanwhile, instead of failing
+            if self.posix_rename and not hasattr(sftp, 'posix_rename'):
+                # paramiko before 2.2
+                logging.debug("paramiko has no posix-rename, falling back to rename")
+                self.posix_rename = False
+            if self.posix_rename:
+                try:
+                    sftp.posix_rename(oldname, newname)
+                    return
+                except IOError as e:
+                    # Not every server has the extension.  paramiko only
+                    # keeps the message of the "operation unsupported" status
+                    # such a server answers with; any other error, such as a
+                    # dropped connection, is for _run() to deal with.
+                    if e.errno is not None or 'unsupported' not in str(e).lower():
+                        raise
+                    logging.debug("posix-rename failed, falling back to rename: %s" % (e))
+                    self.posix_rename = False
+            try:
+                sftp.rename(oldname, newname)
+            except IOError:
+                exc_info = sys.exc_info()
+                try:
+                    sftp.stat(newname)
+                except IOError:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                # someone else uploaded the same object meanwhile
+                logging.debug("'%s' is already on the remote, dropping upload" % (newname))
+                sftp.remove(oldname)
+        self._run(rename)
+
+    def _delete(self, remotefile):
+        self._run(lambda sftp: sftp.remove(remotefile))
+
+    def _exists(self, checksum):
+        def stat(sftp):
+            try:
+                sftp.stat('%s.got' % (checksum))
+                return True
+            except IOError:
+                return False
+        return self._run(stat)
 
-        self.direction = "Uploading"
-        self.filename = filename
-        sftp.put(filename, remotefile, callback=self._print_total)
-        sys.stdout.write("\n")
-        sftp.close()
-        ssh.close()
+    def _exists_many(self, checksums, jobs):
+        # one listing of the remote directory answers for all of them
+        names = set(self._run(lambda sftp: sftp.listdir()))
+        return dict((c, '%s.got' % (c) in names) for c in checksums)
+
+    def close(self):
+        self.pool.close()
 
     def scheme(self):
         return ['ssh']
@@ -242,39 +979,58 @@ class SRR(Remote):
         self.last_mb = -1
         self.filename = "Unset"
         self.upload_len = -1
+        # one keep-alive session for all of the requests to the server, made
+        # when the first request is
+        self._session = None
+        self.session_lock = threading.Lock()
+        # download URLs already resolved, keyed by checksum
+        self.urls = {}
+
+    @property
+    def session(self):
+        with self.session_lock:
+            if self._session is None:
+                self._session = requests.Session()
+            return self._session
+
+    def _mount_adapters(self, jobs):
+        # requests keeps 10 connections per host by default; with more jobs
+        # than that, the extra connections would be dropped after every
+        # request instead of being kept alive
+        size = max(10, jobs)
+        for prefix in self.scheme():
+            self.session.mount('%s://' % prefix,
+                               requests.adapters.HTTPAdapter(pool_connections=size,
+                                                             pool_maxsize=size))
 
     def _get_location_info_srr(self):
         logging.debug("srr._get_location_info_srr")
         parser = urlparse.urlparse(self.configuration['remote'])
-        return (parser.scheme, parser.hostname, os.path.basename(parser.path))
+        server = parser.hostname
+        if parser.port is not None:
+            server = '%s:%d' % (server, parser.port)
+        return (parser.scheme, server, os.path.basename(parser.path))
 
     def upload_cb(self, monitor):
         print_transfer_string(monitor.bytes_read, self.upload_len, self.filename,
                               "Uploading")
 
     @store_with_cache
-    def store(self, filename, checksum):
+    def store(self, source, checksum):
         logging.debug("store_srr")
+        filename = source.filename
         (scheme, server_name, parent_id) = self._get_location_info_srr()
         target_id = ''
         remote_path = '%s' % checksum
         description = 'Got storage for %s @ TBD hashtag' % (filename)
 
-        # first check to see if the file already exists in the SRR
-        r = requests.get('%s://%s/srr/api/file_metadata/sha256/%s' % (scheme, server_name, checksum))
-        if r.status_code == 200:
-            logging.debug("File existed on remote, skipping upload...")
-            return
-
-        # if the response was 404, the object was not in the store and thus we
-        # need to upload it
-        logging.debug("Uploading file to remote...")
-
+        # The SRR has no way to rename an object, so the file must have been
+        # hashed before it is uploaded; the upload still fills the local cache.
         e = requests_toolbelt.multipart.encoder.MultipartEncoder(fields={
           'parent_id' : parent_id,
           'target_id' : '',
           'description' : description,
-          'file' : (checksum, open(filename, 'rb'), 'application/octet-stream')})
+          'file' : (checksum, source, 'application/octet-stream')})
 
         # In requests_toolbelt 0.3 and earlier, the MultipartEncoder class had
         # a __len__ method, so you could call len(e) to get the total length.
@@ -290,11 +1046,11 @@ class SRR(Remote):
         m = requests_toolbelt.multipart.encoder.MultipartEncoderMonitor(e,
                                                                         self.upload_cb)
 
-        response = requests.post('%s://%s/srr/api/add_file' % (scheme, server_name), data = m, headers = {'Content-Type' : m.content_type})
+        response = self.session.post('%s://%s/srr/api/add_file' % (scheme, server_name), data = m, headers = {'Content-Type' : m.content_type})
 
         if response.status_code != 200:
             raise Exception("%s: %s" % (response.reason, response.status_code))
-        sys.stdout.write("\n")
+        source.check(checksum)
         new_id_re = re.compile(r' file_id=(\d+)\s*$')
         m = new_id_re.search(response.text)
         if m:
@@ -303,10 +1059,66 @@ class SRR(Remote):
             raise Exception("Unexpected result from SRR")
 
     def _get_remote_path_srr(self, scheme, server, checksum):
-        response = requests.get('%s://%s/srr/api/file_metadata/sha256/%s' % (scheme, server, checksum))
-        if response.status_code == 404:
+        url = self.urls.get(checksum)
+        if url is not None:
+            return url
+        response = self.session.get('%s://%s/srr/api/file_metadata/sha256/%s' % (scheme, server, checksum))
+        if response.status_code != 200:
             raise Exception("Unexpected result from SRR: %d" % response.status_code)
-        return urllib.quote(response.json()['url'].encode('utf-8'), ':/%')
+        url = urllib.quote(response.json()['url'].encode('utf-8'), ':/%')
+        self.urls[checksum] = url
+        return url
+
+    def _exists(self, checksum):
+        (scheme, server, parent_id) = self._get_location_info_srr()
+        try:
+            self._get_remote_path_srr(scheme, server.encode('utf-8'), checksum.encode('utf-8'))
+        except Exception as e:
+            logging.debug("srr: %s not found: %s" % (checksum, e))
+            return False
+        return True
+
+    def _exists_many(self, checksums, jobs):
+        # the server has no bulk query, so at least ask it concurrently (the
+        # answers also give us the URLs, should we want to load them)
+        self._mount_adapters(jobs)
+        if jobs <= 1 or len(checksums) <= 1:
+            return dict((c, self._exists(c)) for c in checksums)
+
+        pool = multiprocessing.pool.ThreadPool(min(jobs, len(checksums)))
+        try:
+            found = pool.map_async(self._exists, checksums).get(sys.maxint)
+        finally:
+            pool.terminate()
+            pool.join()
+        return dict(zip(checksums, found))
+
+    def prepare_load(self, checksums, jobs):
+        logging.debug("prepare_load_srr: resolving %d objects" % len(checksums))
+        # each job may be downloading an object in segments
+        self._mount_adapters(jobs * transfer_segments)
+        (scheme, server, parent_id) = self._get_location_info_srr()
+        server = server.encode('utf-8')
+
+        def resolve(checksum):
+            try:
+                self._get_remote_path_srr(scheme, server, checksum.encode('utf-8'))
+            except Exception as e:
+                # leave it to load() to report the failure for this file
+                logging.debug("Failed to resolve %s: %s" % (checksum, e))
+
+        pending = [c for c in set(checksums) if c not in self.urls]
+        if jobs <= 1 or len(pending) <= 1:
+            for checksum in pending:
+                resolve(checksum)
+            return
+
+        pool = multiprocessing.pool.ThreadPool(min(jobs, len(pending)))
+        try:
+            pool.map_async(resolve, pending).get(sys.maxint)
+        finally:
+            pool.terminate()
+            pool.join()
 
     def _curlprogress(self, down_total, down_current, up_total, up_current):
         if down_total == 0:
@@ -319,7 +1131,8 @@ class SRR(Remote):
                                   "Downloading")
 
     @load_with_cache
-    def load(self, filename, checksum):
+    def load(self, writer, checksum):
+        filename = writer.filename
         checksum = checksum.encode('utf-8')
         logging.debug("load_srr %s %s" % (filename, checksum))
         (scheme, server, parent_id) = self._get_location_info_srr()
@@ -331,130 +1144,278 @@ class SRR(Remote):
 
         self.last_mb = -1
         self.filename = filename
-        total_length = 0
-        count = 0
-        r = requests.get(path, stream=True)
-        with open(filename, 'wb') as f:
-            total_length = int(r.headers['Content-Length'])
-            for chunk in r.iter_content(chunk_size=4096):
-                if chunk: # filter out keep-alive new chunks
-                    count = count+len(chunk)
-                    f.write(chunk)
-                    print_transfer_string(count, total_length, filename, "Downloading")
-
-        sys.stdout.write("\n")
+        headers = {}
+        if writer.offset > 0:
+            # continue a download that failed before
+            headers['Range'] = 'bytes=%d-' % writer.offset
+        r = self.session.get(path, stream=True, headers=headers)
+        with contextlib.closing(r):
+            if r.status_code == 416 and writer.offset > 0:
+                # nothing left to fetch; commit() will tell if that's right
+                return
+            if r.status_code == 200:
+                # the server sent the whole object
+                writer.restart()
+            elif r.status_code != 206 or writer.offset == 0:
+                raise Exception("%s: %s" % (r.reason, r.status_code))
+            total_length = writer.offset + int(r.headers['Content-Length'])
+            segmented = (transfer_segments > 1 and
+                         total_length - writer.offset >= segment_threshold and
+                         (r.status_code == 206 or
+                          r.headers.get('Accept-Ranges') == 'bytes'))
+            if not segmented:
+                for chunk in r.iter_content(chunk_size=4096):
+                    if chunk: # filter out keep-alive new chunks
+                        writer.write(chunk)
+                        print_transfer_string(writer.offset, total_length, filename, "Downloading")
+
+        if segmented:
+            # drop that response, and fetch the object in pieces instead
+            self._load_segmented(path, writer, total_length)
+
+    def _load_segmented(self, path, writer, total_length):
+        '''
+        Download the rest of an object as transfer_segments byte ranges at the
+        same time, each written at its place in the temporary file, and hash
+        the object once they are all in.
+
+        path: URL of the object
+        writer: VerifyingWriter to write the object into
+        total_length: size of the object
+        '''
+        start = writer.offset
+        size = (total_length - start + transfer_segments - 1) / transfer_segments
+        segments = [(a, min(a + size, total_length)) for a in xrange(start, total_length, size)]
+        logging.debug("load_srr: %d segments of %d bytes" % (len(segments), size))
+        writer.reserve(total_length)
+
+        written = [0] * len(segments)
+        lock = threading.Lock()
+        # The first segment that failed.  Only what arrived in one piece from
+        # the start can be kept to resume from, so the segments before it
+        # carry on, while those after it give up.
+        first_failed = [len(segments)]
+
+        def fetch(i):
+            try:
+                fetch_segment(i)
+            except:
+                with lock:
+                    first_failed[0] = min(first_failed[0], i)
+                raise
+
+        def fetch_segment(i):
+            (a, b) = segments[i]
+            r = self.session.get(path, stream=True,
+                                 headers={'Range': 'bytes=%d-%d' % (a, b - 1)})
+            with contextlib.closing(r):
+                if r.status_code != 206:
+                    raise Exception("%s: %s" % (r.reason, r.status_code))
+                with contextlib.closing(writer.open_at(a)) as fp:
+                    for chunk in r.iter_content(chunk_size=65536):
+                        if first_failed[0] < i:
+                            raise Exception("Download of an earlier segment failed")
+                        if written[i] + len(chunk) > b - a:
+                            raise Exception("Unexpected result from SRR: too much data")
+                        fp.write(chunk)
+                        with lock:
+                            written[i] += len(chunk)
+                            done = start + sum(written)
+                            print_transfer_string(done, total_length, writer.filename, "Downloading")
+            if written[i] != b - a:
+                raise Exception("Unexpected result from SRR: short read")
+
+        pool = multiprocessing.pool.ThreadPool(len(segments))
+        failed = None
+        try:
+            pool.map_async(fetch, range(len(segments))).get(sys.maxint)
+        except KeyboardInterrupt:
+            failed = sys.exc_info()
+            first_failed[0] = -1
+        except:
+            failed = sys.exc_info()
+        pool.close()
+        pool.join()
+
+        if failed is not None:
+            # keep what arrived in one piece from the start, to resume from
+            prefix = 0
+            for (i, (a, b)) in enumerate(segments):
+                prefix += written[i]
+                if written[i] != b - a:
+                    break
+            writer.absorb(prefix)
+            raise failed[0], failed[1], failed[2]
+        writer.absorb(total_length - start)
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
 
     def scheme(self):
         return ['http','https']
 
 ############################ FILE BACKEND #####################################
 class File(Remote):
+    can_rename = True
+
     def __init__(self, configuration):
         Remote.__init__(self, configuration)
         self.block_size = 1048576
 
-    @store_with_cache
-    def store(self, filename, checksum):
+    def _remote_path(self, remotefile):
+        parser = urlparse.urlparse(self.configuration['remote'])
+        return os.path.join(parser.path, remotefile)
+
+    def _put(self, source, remotefile):
         logging.debug("store_file")
+        with open(self._remote_path(remotefile), 'wb') as dst:
+            copy_stream(source, dst, source.size, "Uploading", source.filename,
+                        self.block_size)
+            # on disk before it is renamed into place
+            dst.flush()
+            os.fsync(dst.fileno())
+
+    def _rename(self, oldname, newname):
+        os.rename(self._remote_path(oldname), self._remote_path(newname))
+
+    def _delete(self, remotefile):
+        os.remove(self._remote_path(remotefile))
+
+    def _exists(self, checksum):
         parser = urlparse.urlparse(self.configuration['remote'])
-        dstpath = os.path.join(parser.path, checksum + ".got")
-        if os.path.exists(dstpath):
-            logging.debug("File existed on remote, skipping upload...")
-            return
+        return os.path.exists(os.path.join(parser.path, checksum + ".got"))
 
-        copy_file(filename, dstpath, "Uploading", filename, self.block_size)
+    def _exists_many(self, checksums, jobs):
+        parser = urlparse.urlparse(self.configuration['remote'])
+        names = set(os.listdir(parser.path))
+        return dict((c, c + ".got" in names) for c in checksums)
 
     @load_with_cache
-    def load(self, filename, checksum):
+    def load(self, writer, checksum):
         logging.debug("load_file")
         parser = urlparse.urlparse(self.configuration['remote'])
 
-        copy_file(os.path.join(parser.path, checksum + ".got"), filename,
-                  "Downloading", filename, self.block_size)
+        with open(os.path.join(parser.path, checksum + ".got"), 'rb') as src:
+            total = file_length(src)
+            if writer.offset > total:
+                writer.restart()
+            # continue where a download that failed before stopped
+            src.seek(writer.offset)
+            copy_stream(src, writer, total - writer.offset, "Downloading",
+                        writer.filename, self.block_size)
 
     def scheme(self):
         return ['file']
 
 ############################ FTP BACKEND #####################################
 class FTP(Remote):
+    can_rename = True
+
     def __init__(self, configuration):
         Remote.__init__(self, configuration)
         self.block_size = 8192
-        self.total_transferred = 0
-        self.total = 0
-        self.filename = None
-        self.remote_file = None
-        self.exists_on_remote = False
-        self.download_fp = None
-
-    def _transfer_cb(self, block):
-        self.total_transferred += len(block)
-        print_transfer_string(self.total_transferred, self.total, self.filename, "Uploading")
-
-    def _file_exists_cb(self, name):
-        if name == self.remote_file:
-            self.exists_on_remote = True
-
-    @store_with_cache
-    def store(self, filename, checksum):
-        logging.debug("store_ftp")
+        self.pool = SessionPool(self._ftp_connect,
+                                lambda ftp: ftp.sock is not None,
+                                self._ftp_disconnect)
+        # names in the remote directory, fetched with a single NLST the first
+        # time they are needed and kept up to date as we upload
+        self.listing = None
+        self.listing_lock = threading.Lock()
+
+    @profiled('ftp.connect')
+    def _ftp_connect(self):
         parser = urlparse.urlparse(self.configuration['remote'])
-
-        remotefile = '%s.got' % (checksum)
-
-        ftp = ftplib.FTP(parser.hostname)
+        ftp = ftplib.FTP()
+        ftp.connect(parser.hostname, parser.port or ftplib.FTP_PORT)
         ftp.login(parser.username, parser.password)
         ftp.set_pasv(True)
         # Change to the right directory.  Note that we strip off the starting
         # slash since that isn't generally what is wanted.
         ftp.cwd(parser.path[1:])
+        return ftp
 
-        self.remote_file = remotefile
-        self.exists_on_remote = False
-        ftp.retrlines("NLST", self._file_exists_cb)
-        if self.exists_on_remote:
-            logging.debug("File existed on remote, skipping upload...")
-            return
+    def _ftp_disconnect(self, ftp):
+        try:
+            ftp.quit()
+        except ftplib.all_errors:
+            ftp.close()
+
+    def _run(self, operation):
+        '''
+        Run operation(ftp) on a pooled, logged in FTP connection, reconnecting
+        if the connection has gone away.
+        '''
+        return self.pool.run(operation, (socket.error, EOFError, ftplib.error_temp))
+
+    def _remote_names(self):
+        with self.listing_lock:
+            if self.listing is None:
+                names = self._run(lambda ftp: ftp.nlst())
+                # some servers answer NLST with paths rather than bare names
+                self.listing = set(os.path.basename(name) for name in names)
+            return self.listing
+
+    def _put(self, source, remotefile):
+        logging.debug("store_ftp")
+
+        def upload(ftp):
+            # start over if this is a retry on a new connection
+            source.restart()
+            transferred = [0]
+            def transfer_cb(block):
+                transferred[0] += len(block)
+                print_transfer_string(transferred[0], source.size, source.filename, "Uploading")
+            ftp.storbinary('STOR %s' % remotefile, source, self.block_size, transfer_cb)
+            print_transfer_string(source.size, source.size, source.filename, "Uploading")
 
-        with open(filename, 'rb') as fp:
-            self.total = file_length(fp)
-            self.total_transferred = 0
-            self.filename = filename
-            ftp.storbinary('STOR %s' % remotefile, fp, self.block_size, self._transfer_cb)
+        self._run(upload)
 
-        print_transfer_string(self.total, self.total, self.filename, "Uploading")
-        ftp.close()
+    def _rename(self, oldname, newname):
+        self._run(lambda ftp: ftp.rename(oldname, newname))
+        self._remote_names()
+        with self.listing_lock:
+            self.listing.add(newname)
 
-        sys.stdout.write("\n")
+    def _delete(self, remotefile):
+        self._run(lambda ftp: ftp.delete(remotefile))
 
-    def _write_and_print_cb(self, block):
-        self.total_transferred += len(block)
-        self.download_fp.write(block)
-        print_transfer_string(self.total_transferred, self.total, self.filename, "Downloading")
+    def _exists(self, checksum):
+        return '%s.got' % (checksum) in self._remote_names()
+
+    def _exists_many(self, checksums, jobs):
+        names = self._remote_names()
+        return dict((c, '%s.got' % (c) in names) for c in checksums)
 
     @load_with_cache
-    def load(self, filename, checksum):
+    def load(self, writer, checksum):
         logging.debug("load_ftp")
-        parser = urlparse.urlparse(self.configuration['remote'])
-
-        ftp = ftplib.FTP(parser.hostname)
-        ftp.login(parser.username, parser.password)
-        ftp.set_pasv(True)
-        # Change to the right directory.  Note that we strip off the starting
-        # slash since that isn't generally what is wanted.
-        ftp.cwd(parser.path[1:])
 
         remotefile = '%s.got' % (checksum)
 
-        self.total = ftp.size(remotefile)
-        self.filename = filename
-        self.total_transferred = 0
-        with open(filename, 'wb') as self.download_fp:
-            ftp.retrbinary("RETR %s" % remotefile, self._write_and_print_cb)
+        def download(ftp):
+            # Keep the transfer state local to this call (rather than on self)
+            # so that several downloads can be running at the same time.
+            # Servers may refuse SIZE in ASCII mode, which is what a new
+            # connection (or one that has just run NLST) is in.
+            ftp.voidcmd('TYPE I')
+            total = ftp.size(remotefile)
+            if writer.offset > total:
+                writer.restart()
+            if writer.offset == total:
+                return
+            def write_and_print_cb(block):
+                writer.write(block)
+                print_transfer_string(writer.offset, total, writer.filename, "Downloading")
+            # continues where the last attempt stopped (REST), also when this
+            # is a retry on a new connection
+            ftp.retrbinary("RETR %s" % remotefile, write_and_print_cb,
+                           rest=writer.offset or None)
 
-        ftp.close()
+        self._run(download)
 
-        sys.stdout.write("\n")
+    def close(self):
+        self.pool.close()
 
     def scheme(self):
         return ['ftp']
@@ -478,6 +1439,562 @@ def RemoteObjFactory(remote_type, remote, configuration):
 
     return obj
 
+########################### LOCAL HASH INDEX #################################
+class HashIndex(object):
+    """
+    A persistent record of the SHA-256 of local files, keyed by path.  An entry
+    is only trusted while the stat information of the file is unchanged, which
+    is what lets status and get skip re-hashing files that haven't been
+    touched, much like git's own index.
+    """
+    FORMAT_VERSION = 1
+
+    def __init__(self, path):
+        """
+        @param path  Where the index is stored; None keeps it in memory only
+        """
+        self.path = path
+        self.entries = None
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    @profiled('hash_index.load')
+    def _load(self):
+        # called with self.lock held
+        self.entries = {}
+        if self.path is None or not os.path.isfile(self.path):
+            return
+        try:
+            written = os.stat(self.path).st_mtime
+            with open(self.path, 'rb') as fp:
+                data = json.load(fp)
+        except (IOError, OSError, ValueError) as e:
+            logging.debug('Ignoring unreadable hash index %s: %s' % (self.path, e))
+            return
+        if data.get('version') != self.FORMAT_VERSION:
+            return
+        for (filename, entry) in data['entries'].iteritems():
+            # A file modified in the same instant the index was written may
+            # have changed again without its mtime moving ("racily clean" in
+            # git terms), so it has to be hashed once more.
+            if entry[1] >= written:
+                continue
+            self.entries[filename.encode('utf-8')] = (tuple(entry[:4]), str(entry[4]))
+
+    def lookup(self, filename, key):
+        """
+        @param filename  The path of the file, relative to the repository root
+        @param key       The current stat_key() of the file
+        @return The recorded SHA-256 of the file, or None if it is not known or
+                the file changed since
+        """
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            entry = self.entries.get(filename)
+        if entry is None or entry[0] != key:
+            return None
+        return entry[1]
+
+    def record(self, filename, key, digest):
+        """
+        @param filename  The path of the file, relative to the repository root
+        @param key       The stat_key() of the file at the time it was hashed
+        @param digest    The SHA-256 of the file
+        """
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            self.entries[filename] = (key, digest)
+            self.dirty = True
+
+    def forget(self, filename):
+        """
+        @param filename  The path of the file, relative to the repository root
+        """
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            if self.entries.pop(filename, None) is not None:
+                self.dirty = True
+
+    @profiled('hash_index.save')
+    def save(self):
+        """
+        Write the index back out, if anything changed.
+        """
+        with self.lock:
+            if not self.dirty or self.path is None:
+                return
+            entries = {}
+            for (filename, (key, digest)) in self.entries.iteritems():
+                entries[filename] = list(key) + [digest]
+            tmp = temp_path(self.path)
+            try:
+                mkdir_p(os.path.dirname(self.path))
+                with open(tmp, 'wb') as fp:
+                    json.dump({'version': self.FORMAT_VERSION, 'entries': entries}, fp)
+                os.rename(tmp, self.path)
+            except (IOError, OSError) as e:
+                # the index is only an optimization; losing it costs a re-hash
+                logging.warning('Failed to write hash index %s: %s' % (self.path, e))
+                return
+            self.dirty = False
+
+hash_index = HashIndex(None)
+
+########################### USAGE STATISTICS #################################
+class UsageStats(object):
+    """
+    Counters of how well the local cache and the remotes serve this
+    repository, kept across commands: how often the local cache had the
+    object that was asked for, and how much was downloaded from, uploaded to,
+    and not uploaded to (as it was there already) each remote.  A command
+    counts in memory, and adds its counts to the stored ones at the end,
+    under a lock, so that commands running at the same time don't lose each
+    other's counts.
+    """
+    FORMAT_VERSION = 1
+
+    # name -> description, of the counters kept for the whole repository
+    COUNTERS = collections.OrderedDict([
+        ('cache_lookups', 'Objects looked for in the local cache'),
+        ('cache_hits', 'Objects found in the local cache'),
+        ('cache_hit_bytes', 'Bytes of the objects found in the local cache'),
+    ])
+    # and of those kept for each remote
+    REMOTE_COUNTERS = collections.OrderedDict([
+        ('download_objects', 'Objects downloaded from the remote'),
+        ('download_bytes', 'Bytes downloaded from the remote'),
+        ('upload_objects', 'Objects uploaded to the remote'),
+        ('upload_bytes', 'Bytes uploaded to the remote'),
+        ('upload_skipped_objects', 'Objects not uploaded as the remote had them already'),
+        ('upload_skipped_bytes', 'Bytes not uploaded as the remote had them already'),
+    ])
+
+    def __init__(self, path):
+        """
+        @param path  Where the counters are stored; None keeps them in memory
+                     only
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        # what this command counted, as in the stored data: a dict of the
+        # counters, and a dict of the counters of each remote
+        self.counters = {}
+        self.remotes = {}
+
+    def add(self, name, n, remote=None):
+        """
+        @param name    The counter, from COUNTERS, or from REMOTE_COUNTERS if
+                       remote is given
+        @param n       How much to add to it
+        @param remote  The name of the remote the counter is for
+        """
+        with self.lock:
+            if remote is None:
+                counters = self.counters
+            else:
+                counters = self.remotes.setdefault(remote, {})
+            counters[name] = counters.get(name, 0) + n
+
+    def _read(self):
+        # called with the file locked
+        if self.path is None or not os.path.isfile(self.path):
+            return ({}, {})
+        try:
+            with open(self.path, 'rb') as fp:
+                data = json.load(fp)
+        except (IOError, OSError, ValueError) as e:
+            logging.warning('Ignoring unreadable statistics %s: %s' % (self.path, e))
+            return ({}, {})
+        if data.get('version') != self.FORMAT_VERSION:
+            return ({}, {})
+        return (data['counters'], data['remotes'])
+
+    def load(self):
+        """
+        @return The stored counters, as a (counters, counters of each remote)
+                tuple of dicts
+        """
+        if self.path is None:
+            return ({}, {})
+        mkdir_p(os.path.dirname(self.path))
+        with file_lock(self.path + '.lock'):
+            return self._read()
+
+    def save(self):
+        """
+        Add what this command counted to the stored counters.
+        """
+        with self.lock:
+            if self.path is None or (len(self.counters) == 0 and len(self.remotes) == 0):
+                return
+            try:
+                mkdir_p(os.path.dirname(self.path))
+                with file_lock(self.path + '.lock'):
+                    (counters, remotes) = self._read()
+                    for (name, n) in self.counters.iteritems():
+                        counters[name] = counters.get(name, 0) + n
+                    for (remote, added) in self.remotes.iteritems():
+                        stored = remotes.setdefault(remote, {})
+                        for (name, n) in added.iteritems():
+                            stored[name] = stored.get(name, 0) + n
+                    tmp = temp_path(self.path)
+                    with open(tmp, 'wb') as fp:
+                        json.dump({'version': self.FORMAT_VERSION,
+                                   'counters': counters, 'remotes': remotes}, fp)
+                    os.rename(tmp, self.path)
+            except (IOError, OSError) as e:
+                logging.warning('Failed to write statistics %s: %s' % (self.path, e))
+                return
+            self.counters = {}
+            self.remotes = {}
+
+usage_stats = UsageStats(None)
+
+def prometheus_text(counters, remotes):
+    """
+    Format counters in the Prometheus text exposition format.
+
+    @param counters  The counters of the repository, as UsageStats.load()
+                     gives them
+    @param remotes   The counters of each remote, likewise
+    @return The text
+    """
+    def escape(value):
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    lines = []
+    for (name, description) in UsageStats.COUNTERS.iteritems():
+        metric = 'git_got_%s_total' % name
+        lines.append('# HELP %s %s.' % (metric, description))
+        lines.append('# TYPE %s counter' % metric)
+        lines.append('%s %d' % (metric, counters.get(name, 0)))
+    for (name, description) in UsageStats.REMOTE_COUNTERS.iteritems():
+        metric = 'git_got_%s_total' % name
+        lines.append('# HELP %s %s.' % (metric, description))
+        lines.append('# TYPE %s counter' % metric)
+        for remote in sorted(remotes):
+            lines.append('%s{remote="%s"} %d' % (metric, escape(remote),
+                                                 remotes[remote].get(name, 0)))
+    return '\n'.join(lines) + '\n'
+
+############################### MANIFEST #####################################
+# The manifest of the repository, if it uses one (see Manifest); set by
+# _main()
+MANIFEST_FILE = '.got-manifest'
+manifest = None
+
+class Manifest(object):
+    """
+    The got tracking information of every file in the repository, in a single
+    file at the top of the working tree, instead of a .<name>.got file next to
+    each tracked file.  After a version line, the manifest has one line per
+    tracked file, sorted by path:
+
+        <path> TAB <sha-256> TAB <mode, in octal> TAB <remote>
+
+    Being sorted, a file is found with a binary search, and the files under a
+    directory are next to each other.  Tabs, newlines and backslashes in paths
+    are escaped with a backslash.
+    """
+    HEADER = '# git-got manifest'
+    FORMAT_VERSION = 1
+
+    class _Paths(object):
+        # the (escaped) paths of the manifest lines, as a sequence for bisect
+        def __init__(self, lines):
+            self.lines = lines
+        def __len__(self):
+            return len(self.lines)
+        def __getitem__(self, i):
+            return self.lines[i].split('\t', 1)[0]
+
+    def __init__(self, path, create=False):
+        """
+        @param path    Where the manifest is, relative to the repository root
+        @param create  Whether to start a new, empty manifest
+        """
+        self.path = path
+        self.lines = [] if create else None
+        self.dirty = create
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _escape(path):
+        return path.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+    @staticmethod
+    def _unescape(path):
+        return re.sub(r'\\(.)', lambda m: {'t': '\t', 'n': '\n'}.get(m.group(1), m.group(1)), path)
+
+    @profiled('manifest.load')
+    def _load(self):
+        # called with self.lock held
+        with open(self.path, 'rb') as fp:
+            lines = fp.read().split('\n')
+        header = '%s %d' % (self.HEADER, self.FORMAT_VERSION)
+        if lines[0] != header:
+            raise GotException("'%s' is not a version %d git-got manifest; a newer git-got may be needed" % (self.path, self.FORMAT_VERSION))
+        self.lines = [line for line in lines[1:] if line]
+
+    def _find(self, key):
+        # called with self.lock held; returns the index of the line for the
+        # escaped path key, or where it would go, and whether it is there
+        if self.lines is None:
+            self._load()
+        paths = self._Paths(self.lines)
+        i = bisect.bisect_left(paths, key)
+        return (i, i < len(paths) and paths[i] == key)
+
+    def get(self, path):
+        """
+        @param path  The path of the file, relative to the repository root
+        @return The tracking information of the file, as in a .got file (a
+                dict with its 'sha-256', 'remote' and 'mode'), or None if it
+                isn't tracked
+        """
+        with self.lock:
+            (i, found) = self._find(self._escape(path))
+            if not found:
+                return None
+            fields = self.lines[i].split('\t', 3)
+        return {'sha-256': fields[1], 'mode': int(fields[2], 8), 'remote': fields[3]}
+
+    def set(self, path, gotconf):
+        """
+        @param path     The path of the file, relative to the repository root
+        @param gotconf  The tracking information of the file
+        """
+        key = self._escape(path)
+        line = '%s\t%s\t%o\t%s' % (key, gotconf['sha-256'], gotconf['mode'], gotconf['remote'])
+        with self.lock:
+            (i, found) = self._find(key)
+            if found:
+                self.lines[i] = line
+            else:
+                self.lines.insert(i, line)
+            self.dirty = True
+
+    def remove(self, path):
+        """
+        @param path  The path of the file, relative to the repository root
+        @return Whether the file was tracked
+        """
+        with self.lock:
+            (i, found) = self._find(self._escape(path))
+            if found:
+                del self.lines[i]
+                self.dirty = True
+        return found
+
+    def paths(self, directory):
+        """
+        @param directory  A directory relative to the repository root, or '.'
+                          for the whole repository
+        @return The paths of the tracked files under the directory, sorted
+        """
+        with self.lock:
+            if self.lines is None:
+                self._load()
+            if directory in ('.', ''):
+                (start, end) = (0, len(self.lines))
+            else:
+                # every path starting with "directory/" sorts between these
+                prefix = self._escape(directory.rstrip('/') + '/')
+                paths = self._Paths(self.lines)
+                start = bisect.bisect_left(paths, prefix)
+                end = bisect.bisect_left(paths, prefix[:-1] + chr(ord('/') + 1), start)
+            return [self._unescape(self.lines[i].split('\t', 1)[0]) for i in xrange(start, end)]
+
+    @profiled('manifest.save')
+    def save(self, repo):
+        """
+        Write the manifest back out and stage it, if anything changed.
+
+        @param repo  Dulwich repository object
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+            tmp = temp_path(self.path)
+            with open(tmp, 'wb') as fp:
+                fp.write('%s %d\n' % (self.HEADER, self.FORMAT_VERSION))
+                for line in self.lines:
+                    fp.write(line + '\n')
+            os.rename(tmp, self.path)
+            self.dirty = False
+        git_stage.add(self.path)
+
+############################## GIT INDEX #####################################
+class GitStage(object):
+    """
+    The changes a command makes to the git index and to .gitignore.  They are
+    kept in memory and written out once, by flush(), rather than rewriting
+    the index and .gitignore for every file the command touches.
+    """
+    IGNORE_FILE = '.gitignore'
+
+    def __init__(self, repo):
+        """
+        @param repo  Dulwich repository object; None for no repository, in
+                     which case nothing can be staged
+        """
+        self.repo = repo
+        # path -> True to stage the path as it is in the working tree, or
+        # False to drop it from the index
+        self.pending = {}
+        # the paths in the index that are not in HEAD, worked out on first
+        # use and kept up to date as paths are staged
+        self.staged_adds = None
+        self.head_tree = None
+        self.ignore_lines = None
+        self.ignore_set = None
+        self.ignore_dirty = False
+        self.lock = threading.Lock()
+
+    @property
+    def dirty(self):
+        return len(self.pending) != 0 or self.ignore_dirty
+
+    def add(self, path):
+        """
+        Stage a path as it is in the working tree when the changes are
+        flushed; if it is gone by then, it is removed from the index.
+
+        @param path  The path, relative to the repository root
+        """
+        with self.lock:
+            self.pending[path] = True
+            if self.staged_adds is not None:
+                if os.path.lexists(path) and not self._in_head(path):
+                    self.staged_adds.add(path)
+                else:
+                    self.staged_adds.discard(path)
+
+    def remove(self, path):
+        """
+        Drop a path from the index, without looking at the working tree.
+
+        @param path  The path, relative to the repository root
+        """
+        with self.lock:
+            self.pending[path] = False
+            if self.staged_adds is not None:
+                self.staged_adds.discard(path)
+
+    def _in_head(self, path):
+        # called with self.lock held, after _load_staged_adds()
+        if self.head_tree is None:
+            return False
+        try:
+            dulwich.object_store.tree_lookup_path(self.repo.__getitem__, self.head_tree, path)
+        except KeyError:
+            return False
+        return True
+
+    @profiled('git.staged_adds')
+    def _load_staged_adds(self):
+        # called with self.lock held; diffing the index against HEAD walks
+        # the whole tree, so it is only done once per command
+        try:
+            self.head_tree = self.repo[self.repo.head()].tree
+        except KeyError:
+            # no commits yet, so everything in the index is new
+            self.staged_adds = set(self.repo.open_index())
+        else:
+            self.staged_adds = set(get_tree_changes(self.repo).staged['add'])
+        for (path, keep) in self.pending.iteritems():
+            if keep and os.path.lexists(path) and not self._in_head(path):
+                self.staged_adds.add(path)
+            else:
+                self.staged_adds.discard(path)
+
+    def is_staged_add(self, path):
+        """
+        @param path  The path, relative to the repository root
+        @return Whether the path is newly added to the index, i.e. it is
+                staged but not in HEAD
+        """
+        with self.lock:
+            if self.staged_adds is None:
+                self._load_staged_adds()
+            return path in self.staged_adds
+
+    def _load_ignores(self):
+        # called with self.lock held
+        self.ignore_lines = []
+        if os.path.exists(self.IGNORE_FILE):
+            with open(self.IGNORE_FILE, 'rb') as fp:
+                self.ignore_lines = fp.read().splitlines()
+        self.ignore_set = set(self.ignore_lines)
+
+    def ignore(self, path):
+        """
+        Add a path to .gitignore, unless it is there already.
+
+        @param path  The path, relative to the repository root
+        """
+        with self.lock:
+            if self.ignore_set is None:
+                self._load_ignores()
+            if path not in self.ignore_set:
+                self.ignore_set.add(path)
+                self.ignore_lines.append(path)
+                self.ignore_dirty = True
+
+    def unignore(self, path):
+        """
+        Remove a path from .gitignore.
+
+        @param path  The path, relative to the repository root
+        """
+        with self.lock:
+            if self.ignore_set is None:
+                self._load_ignores()
+            if path in self.ignore_set:
+                self.ignore_set.remove(path)
+                # drop every line for it now, so that ignoring the path again
+                # puts it back at the end, as a single line
+                self.ignore_lines = [line for line in self.ignore_lines if line != path]
+                self.ignore_dirty = True
+
+    @profiled('git.flush')
+    def flush(self):
+        """
+        Write out .gitignore and the index, if anything changed.
+        """
+        with self.lock:
+            if self.ignore_dirty:
+                tmp = temp_path(self.IGNORE_FILE)
+                with open(tmp, 'wb') as fp:
+                    for line in self.ignore_lines:
+                        fp.write(line + '\n')
+                os.rename(tmp, self.IGNORE_FILE)
+                self.ignore_dirty = False
+                self.pending[self.IGNORE_FILE] = True
+            if len(self.pending) == 0:
+                return
+            index = self.repo.open_index()
+            for (path, keep) in sorted(self.pending.iteritems()):
+                try:
+                    st = os.lstat(path) if keep else None
+                except OSError:
+                    st = None
+                if st is None:
+                    if path in index:
+                        del index[path]
+                else:
+                    blob = dulwich.index.blob_from_path_and_stat(path, st)
+                    self.repo.object_store.add_object(blob)
+                    index[path] = dulwich.index.index_entry_from_stat(st, blob.id, 0)
+            index.write()
+            self.pending = {}
+
+# Set by _main() once the repository is open
+git_stage = GitStage(None)
+
 ##################### CUSTOM EXCEPTION CLASS #################################
 class GotException(Exception):
     def __init__(self, msg, need_usage=False):
@@ -490,53 +2007,913 @@ class GotException(Exception):
                 usagestr += "\n\n"
             usagestr += usage()
 
-        return self.msg + usagestr
+        return self.msg + usagestr
+
+class CallbackErrors(GotException):
+    # Raised by run_callbacks() when the callback failed on some of the
+    # files; output has what the callback returned for each file, and None
+    # for those that failed.
+    def __init__(self, msg, output):
+        GotException.__init__(self, msg)
+        self.output = output
+
+############################# HELPERS #######################################
+def copy_file(srcpath, dstpath, prefix, outfilename, blocksize=1048576):
+    """
+    A function to copy a file from srcpath to dstpath.  While copying it will
+    print a progress string with the prefix and outfilename specified.
+
+    @param srcpath      The source to copy data from
+    @param dstpath      The destination to write data to
+    @param prefix       The prefix to print in the progress string
+    @param outfilename  The filename to print in the progress string
+    @param blocksize    How much data to transfer at a time; defaults to 1048576
+    """
+    # FIXME: we may want to add a check to ensure that dirname(srcpath) exists
+    # before starting the transfer.  Otherwise the error message that happens
+    # isn't entirely clear which part is missing.
+
+    with open(srcpath, 'rb') as src:
+        with open(dstpath, 'wb') as dst:
+            copy_stream(src, dst, file_length(src), prefix, outfilename, blocksize)
+
+def copy_stream(src, dst, total_len, prefix, outfilename, blocksize=1048576):
+    """
+    A function to copy everything from the src file object to the dst file
+    object.  While copying it will print a progress string with the prefix and
+    outfilename specified.
+
+    @param src          The file object to copy data from
+    @param dst          The file object to write data to
+    @param total_len    How much data there is to copy, for the progress string
+    @param prefix       The prefix to print in the progress string
+    @param outfilename  The filename to print in the progress string
+    @param blocksize    How much data to transfer at a time; defaults to 1048576
+    """
+    transferred = 0
+
+    while True:
+        block = src.read(blocksize)
+
+        if not block:
+            # end of file
+            break
+        else:
+            dst.write(block)
+
+        print_transfer_string(transferred, total_len, outfilename, prefix)
+        transferred += len(block)
+
+    print_transfer_string(total_len, total_len, outfilename, prefix)
+
+class ChecksumMismatch(Exception):
+    pass
+
+class VerifyingWriter(object):
+    """
+    A file-like object that downloads are written into.  The data is hashed as
+    it arrives and written to a temporary file, which only replaces the real
+    file once the whole object has arrived and matches its checksum.  The same
+    pass can fill the local cache, so that the object never has to be read
+    back.
+
+    The temporary file can be a partial object kept from an earlier download
+    that failed, in which case the download continues from the end of it (the
+    offset attribute says where).
+    """
+    def __init__(self, filename, checksum, cache_path=None, partial_path=None):
+        """
+        @param filename      The file the object is for
+        @param checksum      The SHA-256 the object must have
+        @param cache_path    Where to store the object in the local cache, or
+                             None to leave the cache alone
+        @param partial_path  Where to keep the object while it is incomplete,
+                             so that the download can be resumed, or None to
+                             use a temporary file that is removed on failure
+        """
+        self.filename = filename
+        self.checksum = checksum.lower()
+        self.hasher = hashlib.sha256()
+
+        self.cache_path = None
+        self.cache_fp = None
+        if cache_path is not None and not os.path.isfile(cache_path):
+            try:
+                cache_mkdir(os.path.dirname(cache_path))
+                self.cache_fp = open(temp_path(cache_path), 'wb')
+                self.cache_path = cache_path
+            except (IOError, OSError) as e:
+                # the cache is only an optimization; do without it
+                logging.debug('Not caching %s: %s' % (filename, e))
+
+        self.offset = 0
+        self.keep = partial_path is not None
+        if partial_path is None:
+            self.tmppath = temp_path(filename)
+            self.fp = open(self.tmppath, 'w+b')
+        elif os.path.isfile(partial_path):
+            self.tmppath = partial_path
+            self.fp = open(self.tmppath, 'r+b')
+            # pick up the hash (and the cached copy) where the last download
+            # stopped
+            while True:
+                data = self.fp.read(HASH_BLOCK_SIZE)
+                if not data:
+                    break
+                self._consume(data)
+            self.fp.seek(self.offset)
+            logging.debug('resuming download of %s at %d' % (filename, self.offset))
+        else:
+            self.tmppath = partial_path
+            self.fp = open(self.tmppath, 'w+b')
+        # how much was kept from before
+        self.resumed = self.offset
+
+    def _consume(self, data):
+        self.hasher.update(data)
+        self.offset += len(data)
+        if self.cache_fp is not None:
+            self.cache_fp.write(data)
+
+    def write(self, data):
+        self.fp.write(data)
+        self._consume(data)
+
+    def reserve(self, size):
+        """
+        Make room for the whole object up front, for it to be written in
+        pieces with open_at().
+
+        @param size  The size of the object
+        """
+        self.fp.flush()
+        self.fp.truncate(size)
+
+    def open_at(self, offset):
+        """
+        Open the temporary file for writing a piece of the object directly,
+        such as when several pieces are downloaded at the same time.  What is
+        written this way only counts once it is absorb()ed.
+
+        @param offset  Where in the object the piece starts
+        @return A file object positioned at offset
+        """
+        fp = open(self.tmppath, 'r+b')
+        fp.seek(offset)
+        return fp
+
+    def absorb(self, length):
+        """
+        Take in data written with open_at(): hash (and cache) the length bytes
+        following what was written so far.
+
+        @param length  How much of the object to take in
+        """
+        # read through a file object of its own, as self.fp may have buffered
+        # what was in the file before the pieces were written
+        with open(self.tmppath, 'rb') as fp:
+            fp.seek(self.offset)
+            while length > 0:
+                data = fp.read(min(HASH_BLOCK_SIZE, length))
+                if not data:
+                    raise IOError("'%s' is shorter than expected" % self.tmppath)
+                self._consume(data)
+                length -= len(data)
+        self.fp.seek(self.offset)
+
+    def restart(self):
+        """
+        Throw away whatever was written so far, to start the transfer over.
+        """
+        self.hasher = hashlib.sha256()
+        self.offset = 0
+        self.resumed = 0
+        self.fp.seek(0)
+        self.fp.truncate()
+        if self.cache_fp is not None:
+            self.cache_fp.seek(0)
+            self.cache_fp.truncate()
+
+    def abort(self, discard=False):
+        """
+        Give up on the transfer, removing the temporary files.  A partial
+        object is kept, to resume from, unless discard is set.
+
+        @param discard  Whether to remove a partial object too
+        """
+        if self.keep and not discard:
+            # anything past offset, written with open_at(), isn't known to
+            # follow on from it
+            self.fp.truncate(self.offset)
+        self.fp.close()
+        if self.cache_fp is not None:
+            self.cache_fp.close()
+        paths = [self.cache_fp and self.cache_fp.name]
+        if discard or not self.keep:
+            paths.append(self.tmppath)
+        for path in paths:
+            if path:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def commit(self):
+        """
+        Check the object against its checksum and, if it matches, move it into
+        place (and into the local cache).  The hash index learns the file's
+        hash, so the next status needn't read it again.
+
+        Raises ChecksumMismatch if the object doesn't match.
+        """
+        digest = self.hasher.hexdigest()
+        if digest != self.checksum:
+            self.abort(discard=True)
+            raise ChecksumMismatch("Checksum mismatch for '%s': expected %s, got %s" % (self.filename, self.checksum, digest))
+
+        self.fp.close()
+        try:
+            os.rename(self.tmppath, self.filename)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # partial objects live in the git directory, which needn't be on
+            # the same filesystem as the working tree
+            tmppath = temp_path(self.filename)
+            shutil.copyfile(self.tmppath, tmppath)
+            os.rename(tmppath, self.filename)
+            os.remove(self.tmppath)
+        key = stat_key(os.stat(self.filename))
+        hash_index.record(self.filename, key, digest)
+
+        if self.cache_fp is not None:
+            self.cache_fp.close()
+            try:
+                install_cache_object(self.cache_fp.name, self.cache_path)
+            except (IOError, OSError) as e:
+                logging.debug('Failed storing %s into our cache: %s' % (self.filename, e))
+                try:
+                    os.remove(self.cache_fp.name)
+                except OSError:
+                    pass
+
+class UploadSource(object):
+    """
+    A file-like object that uploads read the file from.  The data is hashed as
+    the upload reads it, and can be copied into the local cache on the way, so
+    that a single read of the file serves the upload, the hash and the cache.
+    """
+    def __init__(self, filename, cache=True):
+        """
+        @param filename  The file to upload
+        @param cache     Whether to copy the file into the local cache
+        """
+        self.filename = filename
+        self.fp = open(filename, 'rb')
+        self.size = file_length(self.fp)
+        self.hasher = hashlib.sha256()
+
+        self.cache_fp = None
+        if cache:
+            try:
+                mkdir_p(local_cache_path)
+                # the name of the object isn't known until the file is hashed
+                self.cache_fp = open(temp_path(os.path.join(local_cache_path, 'upload')), 'wb')
+            except (IOError, OSError) as e:
+                # the cache is only an optimization; do without it
+                logging.debug('Not caching %s: %s' % (filename, e))
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self.hasher.update(data)
+        if self.cache_fp is not None:
+            self.cache_fp.write(data)
+        return data
+
+    def tell(self):
+        return self.fp.tell()
+
+    def fileno(self):
+        # requests_toolbelt finds out how much there is left to upload from
+        # this and tell()
+        return self.fp.fileno()
+
+    def restart(self):
+        """
+        Go back to the start of the file, to start the transfer over.
+        """
+        self.fp.seek(0)
+        self.hasher = hashlib.sha256()
+        if self.cache_fp is not None:
+            self.cache_fp.seek(0)
+            self.cache_fp.truncate()
+
+    def hexdigest(self):
+        """
+        @return The SHA-256 of the data read so far
+        """
+        return self.hasher.hexdigest()
+
+    def check(self, checksum):
+        """
+        Raises ChecksumMismatch if the data read doesn't match the checksum,
+        meaning that the file changed since it was hashed.
+
+        @param checksum  The SHA-256 the file was expected to have
+        """
+        digest = self.hexdigest()
+        if digest != checksum.lower():
+            raise ChecksumMismatch("'%s' changed while it was being uploaded: expected %s, got %s" % (self.filename, checksum, digest))
+
+    def close(self, checksum=None):
+        """
+        Close the file.  If the data read matches the checksum, the copy of it
+        is moved into the local cache; otherwise the copy is thrown away.
+
+        @param checksum  The SHA-256 of the file, or None if the upload failed
+        """
+        self.fp.close()
+        if self.cache_fp is None:
+            return
+        self.cache_fp.close()
+        if checksum is not None and self.hexdigest() == checksum.lower():
+            path = cache_object_path(checksum)
+            try:
+                cache_mkdir(os.path.dirname(path))
+                install_cache_object(self.cache_fp.name, path)
+                return
+            except (IOError, OSError) as e:
+                logging.debug('Failed storing %s into our cache: %s' % (self.filename, e))
+        try:
+            os.remove(self.cache_fp.name)
+        except OSError:
+            pass
+
+def partial_object_path(checksum):
+    """
+    @param checksum  The checksum of an object
+    @return Where a download of the object is kept while it is incomplete, or
+            None if downloads aren't kept
+    """
+    if partial_dir is None:
+        return None
+    mkdir_p(partial_dir)
+    return os.path.join(partial_dir, checksum.encode('utf-8').lower())
+
+def partial_gc():
+    """
+    Remove the incomplete downloads that have not been resumed for
+    PARTIAL_MAX_AGE, such as those of files that are no longer tracked, or
+    only on another branch.  A download that is still going keeps writing to
+    its partial object, so that object is never that old.  Lock files left
+    behind by a crash go too, once they are as old and their object is gone.
+    """
+    if partial_dir is None or not os.path.isdir(partial_dir):
+        return
+    cutoff = time.time() - PARTIAL_MAX_AGE
+    # the objects first, so that the locks of those removed can go as well
+    filenames = sorted(os.listdir(partial_dir), key=lambda f: f.endswith('.lock'))
+    for filename in filenames:
+        path = os.path.join(partial_dir, filename)
+        if filename.endswith('.lock') and os.path.exists(path[:-len('.lock')]):
+            continue
+        try:
+            if os.stat(path).st_mtime < cutoff:
+                os.remove(path)
+                logging.debug('removed %s, unused for too long' % path)
+        except OSError:
+            # removed by someone else meanwhile
+            pass
+
+def cache_object_path(checksum):
+    """
+    @param checksum  The checksum of an object
+    @return The path of the object in the local cache
+    """
+    checksum = checksum.encode('utf-8').lower()
+    return os.path.join(local_cache_path, checksum[0], checksum[1:])
+
+def cache_mkdir(path):
+    """
+    Make a directory in the local cache, and those between it and the cache
+    directory, as mkdir_p() does.  They get the permission bits of the cache
+    directory, rather than what the umask leaves, so that users can share a
+    cache directory that is writable (and setgid) for their group.  The
+    sticky bit is left out, as it would stop cache_gc() from removing the
+    objects of other users.
+
+    @param path  The directory to make, in the local cache
+    """
+    mkdir_p(local_cache_path)
+    mode = stat.S_IMODE(os.stat(local_cache_path).st_mode) & ~stat.S_ISVTX
+    current = local_cache_path
+    for part in os.path.relpath(path, local_cache_path).split(os.sep):
+        if part in ('', '.'):
+            continue
+        current = os.path.join(current, part)
+        try:
+            os.mkdir(current)
+        except OSError as err:
+            if err.errno != errno.EEXIST or not os.path.isdir(current):
+                raise
+            continue
+        os.chmod(current, mode)
+
+def upload_temp_name():
+    """
+    A name for a remote to receive an upload under, before the upload is
+    renamed to the name of the object.  It is unique to the calling host,
+    process and thread, and doesn't look like an object to exists().
+
+    @return The temporary name
+    """
+    return '.upload.%s.%d.%d.tmp' % (socket.gethostname(), os.getpid(),
+                                     threading.current_thread().ident)
+
+def temp_path(path):
+    """
+    A name to write a file under before renaming it into place at path.  It is
+    in the same directory (so that the rename is atomic), and unique to the
+    calling process and thread.
+
+    @param path  The final path of the file
+    @return The temporary path
+    """
+    return '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+
+def fsync_file(path):
+    """
+    Make sure the contents of the file are on disk, so that a crash after it is
+    renamed into place can't leave a truncated file behind.
+
+    @param path  The file to sync
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _create_lock_file(path):
+    # Create the lock file at path, open, with the permission bits its
+    # directory has for reading and writing rather than what the umask leaves,
+    # so that whoever may use the directory may use the lock file.  It is
+    # made under a temporary name and linked into place, so that nobody sees
+    # it before its permissions are set.  Returns None if path exists already.
+    tmppath = temp_path(path)
+    fd = os.open(tmppath, os.O_RDONLY | os.O_CREAT | os.O_EXCL, 0600)
+    try:
+        directory = os.path.dirname(path) or '.'
+        os.fchmod(fd, 0666 & stat.S_IMODE(os.stat(directory).st_mode))
+        try:
+            os.link(tmppath, path)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+            os.close(fd)
+            fd = None
+    except:
+        os.close(fd)
+        raise
+    finally:
+        os.remove(tmppath)
+    return fd
+
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    Context manager holding an exclusive lock on the lock file at path, which
+    is created as needed and removed again on release.  The lock excludes
+    other processes as well as other threads of this one.
+
+    @param path  The lock file
+    """
+    if fcntl is None:
+        yield
+        return
+
+    while True:
+        # flock() needs no write permission, so that a lock file another user
+        # created can be locked too
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            fd = _create_lock_file(path)
+            if fd is None:
+                # someone else created it meanwhile
+                continue
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            # whoever held the lock before us may have removed the file (and
+            # someone else may have created a new one since), in which case we
+            # hold a lock on a file nobody else will ever see; try again
+            try:
+                locked = os.stat(path).st_ino == os.fstat(fd).st_ino
+            except OSError:
+                locked = False
+        except:
+            os.close(fd)
+            raise
+        if locked:
+            break
+        os.close(fd)
+
+    try:
+        yield
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        os.close(fd)
+
+def reflink_file(srcpath, dstpath):
+    """
+    Make dstpath a copy-on-write clone of srcpath, sharing its data blocks.
+    This only works on filesystems that support it (btrfs, XFS, ...), and
+    only within a single filesystem.
+
+    @param srcpath      The source file
+    @param dstpath      The destination, which is replaced if it exists
+    @return True if the clone was made, False if it isn't supported here
+    """
+    if fcntl is None:
+        return False
+
+    tmppath = temp_path(dstpath)
+    try:
+        with open(srcpath, 'rb') as src:
+            with open(tmppath, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        os.rename(tmppath, dstpath)
+        return True
+    except (IOError, OSError) as e:
+        logging.debug('reflink of %s failed: %s' % (srcpath, e))
+        try:
+            os.remove(tmppath)
+        except OSError:
+            pass
+        return False
+
+def link_file(srcpath, dstpath, mode):
+    """
+    Bring a file out of the local cache without copying it, as far as the link
+    mode allows.
+
+    @param srcpath      The cached object
+    @param dstpath      The destination, which is replaced if it exists
+    @param mode         One of CACHE_LINK_MODES
+    @return True if the file was linked, False if it has to be copied
+    """
+    if mode in ('reflink', 'hardlink'):
+        if reflink_file(srcpath, dstpath):
+            return True
+
+    if mode == 'hardlink':
+        # link under a temporary name and rename it over the destination, as
+        # os.link() refuses to replace an existing file
+        tmppath = temp_path(dstpath)
+        try:
+            os.link(srcpath, tmppath)
+            os.rename(tmppath, dstpath)
+            return True
+        except OSError as e:
+            logging.debug('hard link of %s failed: %s' % (srcpath, e))
+            try:
+                os.remove(tmppath)
+            except OSError:
+                pass
+
+    return False
+
+def install_cache_object(tmppath, path):
+    """
+    Move a complete object, written under a temporary name, into its place in
+    the local cache.  Renaming it into place means that a reader (or a crash)
+    never sees a partial object; writers of the same object are serialized by
+    a lock file.
+
+    @param tmppath  The object, written by the caller
+    @param path     The path of the object in the cache
+    @return True if the object was stored, False if someone else stored it
+            meanwhile (in which case tmppath is removed)
+    """
+    with file_lock(path + '.lock'):
+        if os.path.isfile(path):
+            logging.debug('file was stored in our cache meanwhile')
+            os.remove(tmppath)
+            return False
+        # Cached objects are read-only, as they may end up hard linked into
+        # working trees.
+        os.chmod(tmppath, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        fsync_file(tmppath)
+        os.rename(tmppath, path)
+    global cache_grown
+    cache_grown = True
+    return True
+
+def mark_cache_object_used(path):
+    """
+    Record that a cached object was used just now, for cache_gc().  That is
+    the mtime of the object, if it is ours.  Only the owner of a read-only
+    file can set its mtime, so for the object of another user, it is the
+    mtime of a '.used' stamp file next to it instead, which is writable by
+    whoever may write to the directory.
+
+    @param path  The cached object
+    """
+    try:
+        os.utime(path, None)
+        return
+    except OSError as err:
+        if err.errno not in (errno.EPERM, errno.EACCES):
+            raise
+    stamp = path + USED_SUFFIX
+    fd = os.open(stamp, os.O_WRONLY | os.O_CREAT, 0666)
+    try:
+        if os.fstat(fd).st_uid == os.getuid():
+            os.fchmod(fd, 0666 & stat.S_IMODE(os.stat(os.path.dirname(path)).st_mode))
+    finally:
+        os.close(fd)
+    os.utime(stamp, None)
+
+def apply_mode(filename, mode, unshare=False):
+    """
+    Set the permission bits of a got managed file.  A file hard linked from
+    the local cache is kept read-only, so that it cannot be modified in place
+    (which would modify the cached object too), unless it is unshared first.
+    Its permission bits are those of the cached object and of every other
+    file linked to it, so if it needs different ones, it is unshared too.
+
+    @param filename  The file to change
+    @param mode      The permission bits wanted
+    @param unshare   Whether to replace a hard linked file by a copy of its
+                     own, so that it can be given write permission
+    """
+    st = os.stat(filename)
+    if st.st_nlink > 1:
+        if not unshare:
+            readonly = stat.S_IMODE(mode) & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+            if stat.S_IMODE(st.st_mode) == readonly:
+                return
+        tmppath = temp_path(filename)
+        shutil.copyfile(filename, tmppath)
+        os.rename(tmppath, filename)
+    os.chmod(filename, mode)
 
-############################# HELPERS #######################################
-def copy_file(srcpath, dstpath, prefix, outfilename, blocksize=1048576):
-    '''
-    A function to copy a file from srcpath to dstpath.  While copying it will
-    print a progress string with the prefix and outfilename specified.
+def parse_size(text):
+    """
+    Parse a size such as "500M" or "20G" (the suffixes are powers of 1024).
 
-    @param srcpath      The source to copy data from
-    @param dstpath      The destination to write data to
-    @param prefix       The prefix to print in the progress string
-    @param outfilename  The filename to print in the progress string
-    @param blocksize    How much data to transfer at a time; defaults to 1048576
-    '''
-    # FIXME: we may want to add a check to ensure that dirname(srcpath) exists
-    # before starting the transfer.  Otherwise the error message that happens
-    # isn't entirely clear which part is missing.
+    @param text  The size to parse
+    @return The size in bytes
+    """
+    multipliers = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+    number = text.strip().lower()
+    if number.endswith('b'):
+        number = number[:-1]
+    multiplier = 1
+    if number[-1:] in multipliers:
+        multiplier = multipliers[number[-1]]
+        number = number[:-1]
+    try:
+        size = int(float(number) * multiplier)
+    except (ValueError, OverflowError):
+        # OverflowError for "inf" and the like
+        raise GotException("Invalid size '%s'" % text)
+    if size < 0:
+        raise GotException("Invalid size '%s'" % text)
+    return size
+
+def format_size(size):
+    """
+    @param size  A size in bytes
+    @return The size as a human readable string
+    """
+    for (suffix, divider) in (("GB", 1073741824), ("MB", 1048576), ("KB", 1024)):
+        if size >= divider:
+            return "%.1f %s" % (float(size) / divider, suffix)
+    return "%d bytes" % size
 
-    with open(srcpath, 'rb') as src:
-        with open(dstpath, 'wb') as dst:
-            total_len = file_length(src)
-            transferred = 0
+@profiled('cache.gc')
+def cache_gc(max_size, low_watermark):
+    """
+    Shrink the local cache, if it holds more than max_size bytes, down to
+    low_watermark percent of max_size by removing the least recently used
+    objects.  Objects that are hard linked into working trees are kept, as
+    removing them would not free any space.
+
+    @param max_size       The most the cache may hold, in bytes
+    @param low_watermark  How full to leave the cache, in percent of max_size
+    @return A (number of objects removed, bytes freed, bytes left) tuple
+    """
+    entries = []
+    # object -> when another user last used it (see mark_cache_object_used())
+    used = {}
+    total = 0
+    if os.path.isdir(local_cache_path):
+        for base, dirs, filenames in os.walk(local_cache_path):
+            for filename in filenames:
+                path = os.path.join(base, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    # removed by someone else meanwhile
+                    continue
+                if filename.endswith('.lock'):
+                    continue
+                if filename.endswith(USED_SUFFIX):
+                    used[path[:-len(USED_SUFFIX)]] = st.st_mtime
+                    continue
+                if filename.endswith('.tmp'):
+                    # a day is long enough for any writer still alive to be
+                    # done with it; anything older was left by a crash
+                    if st.st_mtime < time.time() - 86400:
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            pass
+                    continue
+                total += st.st_size
+                if st.st_nlink == 1:
+                    entries.append([st.st_mtime, st.st_size, path])
+
+    for entry in entries:
+        entry[0] = max(entry[0], used.pop(entry[2], 0))
+    for path in used:
+        # the stamp of an object that is gone
+        if not os.path.isfile(path):
+            try:
+                os.remove(path + USED_SUFFIX)
+            except OSError:
+                pass
+
+    removed = 0
+    freed = 0
+    if total > max_size:
+        target = max_size * low_watermark / 100
+        entries.sort()
+        for (mtime, size, path) in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError as e:
+                logging.debug('Failed to evict %s: %s' % (path, e))
+                continue
+            logging.debug('evicted %s from the cache' % path)
+            try:
+                os.remove(path + USED_SUFFIX)
+            except OSError:
+                pass
+            total -= size
+            freed += size
+            removed += 1
+    return (removed, freed, total)
+
+class Progress(object):
+    """
+    The progress line of the transfers in flight.  Transfers report how far
+    they got with update(), as often as they like; the line is redrawn at most
+    every INTERVAL seconds, so that fast links don't spend their time
+    formatting and writing to the terminal.  With a single transfer the line
+    shows that file, with several an aggregate of all of them, along with the
+    throughput and the time left.  Each finished transfer leaves a line
+    behind.  Nothing is written when the output is not a terminal.
+    """
+    INTERVAL = 0.1
+    # over how many seconds the throughput is averaged
+    RATE_WINDOW = 3.0
 
-            while True:
-                block = src.read(blocksize)
+    def __init__(self, out):
+        """
+        @param out  The file object to write the progress to
+        """
+        self.out = out
+        try:
+            self.enabled = out.isatty()
+        except AttributeError:
+            self.enabled = False
+        self.lock = threading.Lock()
+        # filename -> [prefix, transferred, total, transferred at the start]
+        self.transfers = {}
+        # what the transfers that finished while others were running moved,
+        # so that the aggregate doesn't go backwards when one of them finishes
+        self.finished_done = 0
+        self.finished_total = 0
+        self.finished_moved = 0
+        # (time, bytes moved) samples for the throughput
+        self.samples = collections.deque()
+        self.last_draw = 0
+        self.drawn = False
+
+    def update(self, filename, prefix, transferred, total):
+        """
+        @param filename     The local filename being downloaded or uploaded
+        @param prefix       What is happening to it ("Downloading", ...)
+        @param transferred  The number of bytes transferred so far
+        @param total        The total number of bytes in the transfer
+        """
+        if not self.enabled:
+            return
+        now = time.time()
+        with self.lock:
+            entry = self.transfers.get(filename)
+            if entry is None:
+                if len(self.transfers) == 0:
+                    self.samples.clear()
+                    self.samples.append((now, self.finished_moved))
+                # a resumed transfer starts part way; that part doesn't count
+                # towards the throughput
+                self.transfers[filename] = [prefix, transferred, total, transferred]
+            else:
+                entry[0:3] = [prefix, transferred, total]
+            if now - self.last_draw >= self.INTERVAL:
+                self._draw(now)
 
-                if not block:
-                    # end of file
-                    break
-                else:
-                    dst.write(block)
+    def done(self, filename, ok=True):
+        """
+        Finish a transfer.
 
-                print_transfer_string(transferred, total_len, outfilename, prefix)
-                transferred += len(block)
+        @param filename  The local filename that was downloaded or uploaded
+        @param ok        Whether the transfer succeeded; a failed one leaves
+                         no line behind, as the caller reports the failure
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            entry = self.transfers.pop(filename, None)
+            if entry is None:
+                return
+            self._clear()
+            if ok:
+                (prefix, transferred, total, start) = entry
+                self.out.write(transfer_string(total, total, "'%s'" % filename, prefix) + "\n")
+            if len(self.transfers) == 0:
+                self.finished_done = self.finished_total = self.finished_moved = 0
+            else:
+                self.finished_done += entry[1]
+                self.finished_total += entry[2]
+                self.finished_moved += entry[1] - entry[3]
+                self._draw(time.time())
+            self.out.flush()
+
+    def _clear(self):
+        # called with self.lock held
+        if self.drawn:
+            self.out.write("\r\033[K")
+            self.drawn = False
+
+    def _draw(self, now):
+        # called with self.lock held
+        self.last_draw = now
+        done = self.finished_done
+        total = self.finished_total
+        moved = self.finished_moved
+        for (prefix, transferred, size, start) in self.transfers.itervalues():
+            done += transferred
+            total += size
+            moved += transferred - start
+
+        self.samples.append((now, moved))
+        while len(self.samples) > 2 and now - self.samples[1][0] >= self.RATE_WINDOW:
+            self.samples.popleft()
+        (then, moved_then) = self.samples[0]
+        extra = ''
+        if now - then >= self.INTERVAL:
+            rate = (moved - moved_then) / (now - then)
+            extra = ' %s/s' % format_size(rate)
+            if rate > 0 and total > done:
+                eta = int((total - done) / rate)
+                extra += ' ETA %d:%02d' % (eta / 60, eta % 60)
+
+        if len(self.transfers) == 1:
+            (filename, (prefix, transferred, size, start)) = self.transfers.items()[0]
+            line = transfer_string(transferred, size, "'%s'" % filename, prefix, extra)
+        else:
+            prefixes = set(entry[0] for entry in self.transfers.itervalues())
+            prefix = prefixes.pop() if len(prefixes) == 1 else "Transferring"
+            line = transfer_string(done, total, "%d files" % len(self.transfers), prefix, extra)
+        self.out.write("\r" + line + "\033[K")
+        self.out.flush()
+        self.drawn = True
 
-            print_transfer_string(total_len, total_len, outfilename, prefix)
-            sys.stdout.write("\n")
+progress = Progress(sys.stdout)
 
-def print_transfer_string(transferred, total, filename, prefix):
+def transfer_string(transferred, total, label, prefix, extra=''):
     """
-    A function to print out what percentage of a transfer has happened to which
-    file, and in which direction (up or down).
+    A function to describe what percentage of a transfer has happened to which
+    file, and in which direction (up or down), in at most 80 columns.
 
     @param transferred  The number of bytes transferred so far
     @param total        The total number of bytes in transfer
-    @param filename     The local filename being downloaded or uploaded
+    @param label        What is being transferred, typically the quoted
+                        filename
     @param prefix       A string that will be put on the front of the output
+    @param extra        A string that will be put on the end of the output
+    @return The string
     """
     if total > 1073741824:
         suffix = "GB"
@@ -559,33 +2936,39 @@ def print_transfer_string(transferred, total, filename, prefix):
         percent = 100
     else:
         percent = int(transferred * 100 / total)
-    # The "fixed" length for our printed string is the length of the prefix,
-    # plus one for the space, plus one for the opening quote for the filename,
-    # plus one for the closing quote for the filename, plus one for a space,
-    # plus the length of the total size (used to ensure the length stays
-    # constant), plus one for the divide sign, plus one for the length of the
-    # total number, plus one for a space, plus the length of the suffix (GB,
-    # MB, etc), plus one for a space, plus one for the opening parentheses for
-    # the percentage, plus three for the percentage (fixed so that we don't
-    # change how we truncate the filename at the end of the transfer), plus one
-    # for the percent sign, plus one for the closing parentheses.
-    strlen_no_file = len(prefix) + 1 + 1 + 1 + 1 + len(str(divided_total)) + 1 + len(str(divided_total)) + 1 + len(suffix) + 1 + 1 + 3 + 1 + 1
+    # The "fixed" length for our string is the length of the prefix, plus one
+    # for the space, plus one for a space after the label, plus the length of
+    # the total size (used to ensure the length stays constant), plus one for
+    # the divide sign, plus the length of the total number, plus one for a
+    # space, plus the length of the suffix (GB, MB, etc), plus one for a
+    # space, plus one for the opening parentheses for the percentage, plus
+    # three for the percentage (fixed so that we don't change how we truncate
+    # the label at the end of the transfer), plus one for the percent sign,
+    # plus one for the closing parentheses, plus the extra string.
+    strlen_no_label = len(prefix) + 1 + 1 + len(str(divided_total)) + 1 + len(str(divided_total)) + 1 + len(suffix) + 1 + 1 + 3 + 1 + 1 + len(extra)
 
     # Now that we know the fixed length of the string, we can figure out how
-    # much of the filename we can afford to print.  Note that we want to print
+    # much of the label we can afford to print.  Note that we want to print
     # the end of the filename, as that is likely to be the most helpful.  We do
-    # this by reversing the string (filename[::-1]), taking the
-    # first 80-strlen_no_file characters, then reversing back.
-    if strlen_no_file + len(filename) > 80:
-        filename = filename[::-1][:(80-strlen_no_file)][::-1]
-    sys.stdout.write("\r")
-    sys.stdout.write("{0} '{1}' {2}/{3} {4} ({5}%)".format(prefix,
-                                                           filename,
-                                                           divided_tran,
-                                                           divided_total,
-                                                           suffix, percent))
-
-    sys.stdout.flush()
+    # this by reversing the string (label[::-1]), taking the
+    # first 80-strlen_no_label characters, then reversing back.
+    if strlen_no_label + len(label) > 80:
+        label = label[::-1][:(80-strlen_no_label)][::-1]
+    return "{0} {1} {2}/{3} {4} ({5}%){6}".format(prefix, label, divided_tran,
+                                                  divided_total, suffix,
+                                                  percent, extra)
+
+def print_transfer_string(transferred, total, filename, prefix):
+    """
+    A function to report what percentage of a transfer has happened to which
+    file, and in which direction (up or down).  See Progress.
+
+    @param transferred  The number of bytes transferred so far
+    @param total        The total number of bytes in transfer
+    @param filename     The local filename being downloaded or uploaded
+    @param prefix       A string that will be put on the front of the output
+    """
+    progress.update(filename, prefix, transferred, total)
 
 def usage():
     return """git got <command> [<args>]
@@ -597,7 +2980,7 @@ def usage():
                                      the repository.  The <url> is the fully
                                      qualified URL to the remote.
 
-    get [-f]      [<file>...]        With no arguments, retrieve all remote files
+    get [-f] [-j <jobs>] [<file>...] With no arguments, retrieve all remote files
                                      to the local working area.  With one or more
                                      arguments, retrieve just those remote files
                                      to the local working area.  By default, if
@@ -606,9 +2989,14 @@ def usage():
                                      optional -f flag forces git got to download
                                      the file from the remote, even if it already
                                      exists locally or is in the local per-user
-                                     cache (located at ~/.git-got-cache).
-
-    add [-r <remote] [-R] <file>...  Add one or more files to the remote
+                                     cache (located at ~/.git-got-cache).  The
+                                     optional -j argument checks and fetches up
+                                     to <jobs> files at the same time.  Files
+                                     that fail are reported once all of the
+                                     files are done.
+
+    add [-r <remote] [-R] [-j <jobs>] <file>...
+                                     Add one or more files to the remote
                                      repository.  By default, directories are not
                                      allowed.  The optional -r argument allows the
                                      user to specify which remote to use; if not
@@ -616,15 +3004,19 @@ def usage():
                                      optional -R flag can be used to recurse into
                                      the specified directory, adding all the
                                      files not already managed by git into git
-                                     got.
+                                     got.  The optional -j argument hashes the
+                                     files, and checks which of them the remote
+                                     already has, <jobs> at a time.
 
-    status [-v] [<file>...]          With no arguments, request the status of all
+    status [-v] [-j <jobs>] [<file>...]
+                                     With no arguments, request the status of all
                                      got tracked files.  With one or more
                                      arguments, request the status of the named
                                      files.  The optional -v argument requests
                                      verbose mode where the status of all files
                                      are shown, even the ones that haven't
-                                     changed.
+                                     changed.  The optional -j argument hashes
+                                     up to <jobs> files at the same time.
 
     reset <file>...                  Overwrite one or more local got files with
                                      the remote copy.  Note that directories are
@@ -667,11 +3059,47 @@ def usage():
     clear-local-cache                Clear the git got cache available at
                                      ~/.git-got-cache.
 
-    fill-local-cache                 Fills the git got local cache with the
+    fill-local-cache [-j <jobs>]     Fills the git got local cache with the
                                      tracked files from the current project.
+                                     The optional -j argument processes up to
+                                     <jobs> files at the same time.
+
+    upgrade                          Move the tracking information of all of
+                                     the files from their .got files into a
+                                     single manifest file, .got-manifest,
+                                     which is much faster for repositories with
+                                     many files.
+
+    cache-gc [<size>]                Shrink the git got local cache, if it holds
+                                     more than <size> (e.g. "20G"; defaults to
+                                     the got.cacheMaxSize setting), by removing
+                                     the least recently used files.  This also
+                                     happens automatically when got.cacheMaxSize
+                                     is set.
+
+    stats [<file>]                   Show how often the local cache had the
+                                     files fetched, and how much was
+                                     downloaded from, uploaded to, and not
+                                     uploaded to (as it was there already)
+                                     each remote, over all of the commands
+                                     run in this repository.  With <file>,
+                                     write the counters to <file> in the
+                                     Prometheus text format instead, e.g. for
+                                     node_exporter's textfile collector.
+
+  Any command also takes:
+    --profile                        Once the command is done, print how long
+                                     each of its phases took (walking the
+                                     tree, hashing, transfers, the cache, the
+                                     git index...) to stderr.
+
+    --profile-trace <file>           Like --profile, and also write a JSON trace
+                                     of the phases to <file>, which
+                                     chrome://tracing or Perfetto can show.
 
   """
 
+@profiled('hash')
 def file_hash(filename):
     """
     Hash the contents of the specified file using SHA-256 and return the hash
@@ -681,14 +3109,104 @@ def file_hash(filename):
     @return String representing the SHA-256 hash of the file contents
     """
     hasher = hashlib.sha256()
+    size = 0
     with open(filename, 'rb') as infp:
         while True:
-            data = infp.read(8192)
+            data = infp.read(HASH_BLOCK_SIZE)
             if not data:
                 break
             hasher.update(data)
+            size += len(data)
+    profiler.count('hash.bytes', size)
     return hasher.hexdigest()
 
+def stat_key(st):
+    """
+    The parts of a file's stat information that change whenever its contents
+    may have changed.
+
+    @param st  The os.stat() result for the file
+    @return A (size, mtime, inode, ctime) tuple
+    """
+    return (st.st_size, st.st_mtime, st.st_ino, st.st_ctime)
+
+def _stat_and_hash(filename):
+    """
+    Worker for hash_files().  Hashes the file, sandwiched between two stats so
+    that a file changed while being hashed is noticed.
+
+    @param filename  The filename to hash the contents of
+    @return A (stat key, sha-256) tuple, or None if the file could not be
+            hashed or changed while being hashed
+    """
+    try:
+        before = stat_key(os.stat(filename))
+        digest = file_hash(filename)
+        after = stat_key(os.stat(filename))
+    except (IOError, OSError):
+        return None
+    if before != after:
+        return None
+    return (after, digest)
+
+@profiled('hash.parallel')
+def hash_files(filenames, jobs):
+    """
+    Hash many files at the same time on a pool of worker processes, and
+    remember the results in the hash index.  Files that do not exist, or whose
+    hash is already known, are skipped.
+
+    @param filenames  The list of filenames to hash
+    @param jobs       How many files to hash at the same time
+    """
+    if jobs <= 1:
+        # nothing to win; status_local() will hash the files as it goes
+        return
+
+    pending = []
+    for filename in filenames:
+        try:
+            key = stat_key(os.stat(filename))
+        except OSError:
+            continue
+        if hash_index.lookup(filename, key) is None:
+            pending.append(filename)
+
+    if len(pending) <= 1:
+        return
+
+    pool = multiprocessing.Pool(min(jobs, len(pending)))
+    try:
+        # one file per task (chunksize=1), so that a few huge files don't end
+        # up queued behind each other on the same worker
+        results = pool.map_async(_stat_and_hash, pending, 1).get(sys.maxint)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    for (filename, result) in zip(pending, results):
+        if result is not None:
+            hash_index.record(filename, result[0], result[1])
+
+def local_file_hash(filename):
+    """
+    Return the SHA-256 of the given file, taking it from the hash index when
+    the file has not changed since it was last hashed.
+
+    @param filename  The filename to hash the contents of
+    @return String representing the SHA-256 hash of the file contents
+    """
+    key = stat_key(os.stat(filename))
+    digest = hash_index.lookup(filename, key)
+    if digest is None:
+        result = _stat_and_hash(filename)
+        if result is None or result[0] != key:
+            # changed under our feet; don't record anything
+            return file_hash(filename)
+        digest = result[1]
+        hash_index.record(filename, key, digest)
+    return digest
+
 def file_length(fp):
     old = fp.tell()
     fp.seek(0, 2)
@@ -732,13 +3250,99 @@ def status_local(real_filename, got_checksum):
     if not os.path.exists(real_filename):
         logging.debug('status_local: Did not find file %s' % real_filename)
         return False
-    sum1 = file_hash(real_filename)
+    sum1 = local_file_hash(real_filename)
     if sum1 != got_checksum:
         logging.debug('status_local: Got hash %s != file hash %s' % (sum1, got_checksum))
         return False
     return True
 
 ####################### WALKER AND CALLBACKS ##################################
+# The callbacks are handed the name of the .got file of each file, even when
+# the repository keeps its tracking information in a manifest instead; these
+# functions take care of the difference.
+
+def got_file_target(got_filename):
+    """
+    @param got_filename  Got meta filename
+    @return The real filename the got meta file is for
+    """
+    (base, filename) = os.path.split(got_filename)
+    return os.path.normpath(os.path.join(base, filename[1:-4]))
+
+@profiled('got_file.read')
+def read_got_file(got_filename):
+    """
+    @param got_filename  Got meta filename
+    @return The tracking information of the file (a dict with its 'sha-256',
+            'remote' and 'mode'), or None if the file isn't tracked by got
+    """
+    if manifest is not None:
+        return manifest.get(got_file_target(got_filename))
+    if not os.path.exists(got_filename):
+        return None
+    with open(got_filename, 'rb') as storagefp:
+        return json.load(storagefp)
+
+@profiled('got_file.write')
+def write_got_file(repo, got_filename, gotconf):
+    """
+    Record the tracking information of a file, and stage it.
+
+    @param repo           Dulwich repository object
+    @param got_filename   Got meta filename
+    @param gotconf        The tracking information of the file
+    """
+    if manifest is not None:
+        manifest.set(got_file_target(got_filename), gotconf)
+        return
+    with open(got_filename, 'wb') as out:
+        json.dump(gotconf, out)
+    git_stage.add(got_filename)
+
+def remove_got_file(repo, got_filename):
+    """
+    Remove the tracking information of a file, and stage the removal.
+
+    @param repo           Dulwich repository object
+    @param got_filename   Got meta filename
+    """
+    if manifest is not None:
+        manifest.remove(got_file_target(got_filename))
+        return
+    if git_stage.is_staged_add(got_filename):
+        # In theory we should use dulwich.porcelain.rm() here, but for some
+        # reason it doesn't seem to work.  This is basically the same thing.
+        git_stage.remove(got_filename)
+        os.remove(got_filename)
+    else:
+        os.remove(got_filename)
+        git_stage.add(got_filename)
+
+def move_got_file(repo, got_filename, new_got_filename):
+    """
+    Move the tracking information of a file to another file, and stage the
+    move.
+
+    @param repo               Dulwich repository object
+    @param got_filename       Old got meta filename
+    @param new_got_filename   New got meta filename
+    """
+    if manifest is not None:
+        gotconf = manifest.get(got_file_target(got_filename))
+        manifest.remove(got_file_target(got_filename))
+        manifest.set(got_file_target(new_got_filename), gotconf)
+        return
+    if git_stage.is_staged_add(got_filename):
+        # In theory we should use dulwich.porcelain.rm() here, but for some
+        # reason it doesn't seem to work.  This is basically the same thing.
+        git_stage.remove(got_filename)
+        os.rename(got_filename, new_got_filename)
+        git_stage.add(new_got_filename)
+    else:
+        os.rename(got_filename, new_got_filename)
+        git_stage.add(got_filename)
+        git_stage.add(new_got_filename)
+
 def get_cb(repo, got_filename, real_filename, cb_params):
     """
     Fetches the specified file from the remote if necessary.
@@ -751,14 +3355,12 @@ def get_cb(repo, got_filename, real_filename, cb_params):
     force = cb_params
     try:
         logging.debug('get_cb: Using %s for local file' % real_filename)
-        if not os.path.exists(got_filename):
+        gotconf = read_got_file(got_filename)
+        if gotconf is None:
             # this isn't a file tracked by got; this can happen if the user
             # asked to get or reset a file that got is not tracking
             raise Exception("'%s' is not tracked by got" % (real_filename))
 
-        with open(got_filename, 'rb') as storagefp:
-            gotconf = json.load(storagefp)
-
         if not force and status_local(real_filename, gotconf['sha-256']):
             logging.debug("File already exists, and has right checksum; skipping download...")
             return
@@ -766,7 +3368,7 @@ def get_cb(repo, got_filename, real_filename, cb_params):
         for remote_obj in remote_objs:
             if remote_obj.remote_name() == gotconf['remote']:
                 remote_obj.load(real_filename, gotconf['sha-256'], force)
-                os.chmod(real_filename, gotconf['mode'])
+                apply_mode(real_filename, gotconf['mode'])
                 return
         raise Exception("Could not find remote '%s' for file '%s'" % (gotconf['remote'], real_filename))
     except Exception as e:
@@ -784,6 +3386,23 @@ def reset_cb(repo, got_filename, real_filename, cb_params):
     """
     get_cb(repo, got_filename, real_filename, cb_params)
 
+def find_add_remote(remote):
+    """
+    Find the remote that add should store files in.
+
+    @param remote  The name of the remote, or None for the default remote
+    @return The remote object
+    """
+    for tmp in remote_objs:
+        if remote is None:
+            if tmp.remote_default():
+                return tmp
+        else:
+            if tmp.remote_name() == remote:
+                return tmp
+
+    raise Exception("Remote named '%s' does not exist" % (remote))
+
 def add_cb(repo, got_filename, real_filename, cb_params):
     """
     Adds a new file to the got database and uploads it to the remote.
@@ -794,45 +3413,29 @@ def add_cb(repo, got_filename, real_filename, cb_params):
     @param cb_params      A string representing the remote to use
     """
     try:
-        remote = cb_params
-        remote_obj = None
-        for tmp in remote_objs:
-            if remote is None:
-                if tmp.remote_default():
-                    remote_obj = tmp
-                    break
-            else:
-                if tmp.remote_name() == remote:
-                    remote_obj = tmp
-                    break
-
-        if remote_obj is None:
-            raise Exception("Remote named '%s' does not exist" % (remote))
+        remote_obj = find_add_remote(cb_params)
 
         logging.debug('add_cb: Adding %s' % real_filename)
-        csum = file_hash(real_filename)
-        remote_obj.store(real_filename, csum)
+        key = stat_key(os.stat(real_filename))
+        csum = hash_index.lookup(real_filename, key)
+        if csum is None and remote_obj.can_rename and hash_on_upload:
+            # hash the file as it is uploaded, rather than reading it once to
+            # hash it and once more to upload it
+            csum = remote_obj.store_unhashed(real_filename)
+            if stat_key(os.stat(real_filename)) == key:
+                hash_index.record(real_filename, key, csum)
+        else:
+            if csum is None:
+                csum = local_file_hash(real_filename)
+            remote_obj.store(real_filename, csum)
         gotconf = { 'sha-256': csum, 'remote': remote_obj.remote_name(), 'mode': os.stat(real_filename).st_mode }
-        with open(got_filename, 'wb') as out:
-            json.dump(gotconf, out)
-        dulwich.porcelain.add(repo, got_filename)
+        write_got_file(repo, got_filename, gotconf)
 
         # The user may be adding a new file, or updating a filename that already
         # exists.  If it is the former, we want to add the filenames to gitignore;
-        # for the latter, we don't want to add duplicate entries.  Check that here
-        # and do the right thing in both cases.
-        already_in_gitignore = False
-        if os.path.exists('.gitignore'):
-            with open('.gitignore', 'rb') as gitigf:
-                for line in gitigf.xreadlines():
-                    if line == real_filename + "\n":
-                        already_in_gitignore = True
-                        break
-
-        if not already_in_gitignore:
-            with open('.gitignore', 'ab') as gitigf:
-                gitigf.write('%s\n' % real_filename)
-            dulwich.porcelain.add(repo, '.gitignore')
+        # for the latter, we don't want to add duplicate entries.  The stage
+        # takes care of both cases.
+        git_stage.ignore(real_filename)
     except Exception as e:
         raise GotException("Failed to add '%s': %s" % (real_filename, str(e)))
 
@@ -847,8 +3450,9 @@ def status_cb(repo, got_filename, real_filename, cb_params):
     @param cb_params      Verbose or not
     """
     try:
-        with open(got_filename, 'rb') as storagefp:
-            gotconf = json.load(storagefp)
+        gotconf = read_got_file(got_filename)
+        if gotconf is None:
+            raise Exception("'%s' is not tracked by got" % (real_filename))
 
         if not os.path.exists(real_filename):
             return "Missing locally: '%s' (remote '%s')" % (real_filename, gotconf['remote'])
@@ -920,7 +3524,7 @@ def rm_cb(repo, got_filename, real_filename, cb_params):
     @param cb_params      Ignored
     """
     try:
-        if not os.path.exists(got_filename):
+        if read_got_file(got_filename) is None:
             raise Exception("'%s' is not tracked by got" % (real_filename))
 
         # attempt to remove the real file, but if it is already gone, just go on
@@ -929,27 +3533,12 @@ def rm_cb(repo, got_filename, real_filename, cb_params):
             os.remove(real_filename)
         except OSError:
             pass
+        hash_index.forget(real_filename)
         # now remove the got tracking file
-        if got_filename in get_tree_changes(repo).staged['add']:
-            # In theory we should use dulwich.porcelain.rm() here, but for some
-            # reason it doesn't seem to work.  This is basically the same thing.
-            index = repo.open_index()
-            del index[got_filename]
-            index.write()
-            os.remove(got_filename)
-        else:
-            os.remove(got_filename)
-            dulwich.porcelain.add(repo, got_filename)
+        remove_got_file(repo, got_filename)
         # now remove the entry from .gitignore
         logging.debug("Removing file from gitignore")
-        with open('.gitignore', 'rb') as infp:
-            with open('.tmp.gitignore', 'wb') as outfp:
-                for line in infp.xreadlines():
-                    if line != real_filename + "\n":
-                        outfp.write(line)
-
-        os.rename(".tmp.gitignore", ".gitignore")
-        dulwich.porcelain.add(repo, ".gitignore")
+        git_stage.unignore(real_filename)
     except Exception as e:
         raise GotException("Failed to remove '%s': %s" % (real_filename, str(e)))
 
@@ -965,8 +3554,7 @@ def remove_remote_check_cb(repo, got_filename, real_filename, cb_params):
     @param cb_params      The name of the remote
     """
     try:
-        with open(got_filename, 'rb') as storagefp:
-            gotconf = json.load(storagefp)
+        gotconf = read_got_file(got_filename)
 
         remote_name = cb_params
 
@@ -987,8 +3575,9 @@ def chmod_cb(repo, got_filename, real_filename, cb_params):
     @param cb_params      The new mode for the file
     """
     try:
-        with open(got_filename, 'rb') as storagefp:
-            gotconf = json.load(storagefp)
+        gotconf = read_got_file(got_filename)
+        if gotconf is None:
+            raise Exception("'%s' is not tracked by got" % (real_filename))
 
         newmode = int(cb_params, 0)
 
@@ -997,14 +3586,14 @@ def chmod_cb(repo, got_filename, real_filename, cb_params):
 
         # first change the mode in the configuration
         gotconf['mode'] = newmode
-        with open(got_filename, 'wb') as out:
-            json.dump(gotconf, out)
-
-        dulwich.porcelain.add(repo, got_filename)
+        write_got_file(repo, got_filename, gotconf)
 
         # if the file exists, change the mode
         if os.path.exists(real_filename):
-            os.chmod(real_filename, newmode)
+            # asking for write permission is how a file hard linked from the
+            # cache gets a copy of its own
+            apply_mode(real_filename, newmode,
+                       unshare=bool(newmode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)))
     except Exception as e:
         raise GotException("Failed to change mode on '%s': %s" % (real_filename, str(e)))
 
@@ -1021,7 +3610,7 @@ def mv_cb(repo, got_filename, real_filename, cb_params):
     try:
         new_real_filename = cb_params
 
-        if not os.path.exists(got_filename):
+        if read_got_file(got_filename) is None:
             raise Exception("'%s' is not tracked by got" % (real_filename))
 
         (base, filename) = os.path.split(new_real_filename)
@@ -1033,33 +3622,16 @@ def mv_cb(repo, got_filename, real_filename, cb_params):
             os.rename(real_filename, new_real_filename)
         except OSError:
             pass
+        hash_index.forget(real_filename)
 
         # now move the got tracking file
         logging.debug("Moving got tracking file from %s to %s" % (got_filename, new_got_filename))
-        if got_filename in get_tree_changes(repo).staged['add']:
-            # In theory we should use dulwich.porcelain.rm() here, but for some
-            # reason it doesn't seem to work.  This is basically the same thing.
-            index = repo.open_index()
-            del index[got_filename]
-            index.write()
-            os.rename(got_filename, new_got_filename)
-            dulwich.porcelain.add(repo, new_got_filename)
-        else:
-            os.rename(got_filename, new_got_filename)
-            dulwich.porcelain.add(repo, got_filename)
-            dulwich.porcelain.add(repo, new_got_filename)
+        move_got_file(repo, got_filename, new_got_filename)
 
         # now move the .gitignore entry
         logging.debug("Moving file in .gitignore")
-        with open('.gitignore', 'rb') as infp:
-            with open('.tmp.gitignore', 'wb') as outfp:
-                for line in infp.xreadlines():
-                    if line != real_filename + "\n":
-                        outfp.write(line)
-                outfp.write('%s\n' % new_real_filename)
-
-            os.rename(".tmp.gitignore", ".gitignore")
-        dulwich.porcelain.add(repo, ".gitignore")
+        git_stage.unignore(real_filename)
+        git_stage.ignore(new_real_filename)
     except Exception as e:
         raise GotException("Failed to move '%s' to '%s': %s" % (real_filename, new_real_filename, str(e)))
 
@@ -1076,6 +3648,7 @@ def rm_local_cb(repo, got_filename, real_filename, cb_params):
         os.remove(real_filename)
     except OSError:
         pass
+    hash_index.forget(real_filename)
 
 def fill_local_cache_cb(repo, got_filename, real_filename, cb_params):
     """
@@ -1095,8 +3668,9 @@ def fill_local_cache_cb(repo, got_filename, real_filename, cb_params):
         raise GotException("Remote '%s' not known" % conf['remote'])
 
     try:
-        with open(got_filename, 'rb') as storagefp:
-            gotconf = json.load(storagefp)
+        gotconf = read_got_file(got_filename)
+        if gotconf is None:
+            raise Exception("'%s' is not tracked by got" % (real_filename))
 
         if not os.path.exists(real_filename):
             return "Missing locally: '%s' (remote '%s')" % (real_filename, gotconf['remote'])
@@ -1119,14 +3693,25 @@ def fill_local_cache_cb(repo, got_filename, real_filename, cb_params):
     except Exception as e:
         raise GotException("Failed to fill cache for '%s': %s" % (real_filename, str(e)))
 
-def file_is_managed_by_git(repo, filename):
-    w = repo.get_walker(paths=[filename], max_entries=1)
+@profiled('git.managed_paths')
+def git_managed_paths(repo):
+    """
+    Collect the paths of all of the files git manages: those in the HEAD
+    commit and those in the index.  Building the set once is much cheaper
+    than asking git about each file.
+
+    @param repo  Dulwich repository object
+    @return A set of paths, relative to the repository root
+    """
+    paths = set(repo.open_index())
     try:
-        c = iter(w).next().commit
-    except StopIteration:
-        return False
-    else:
-        return True
+        tree = repo[repo.head()].tree
+    except KeyError:
+        # no commits yet
+        return paths
+    for entry in repo.object_store.iter_tree_contents(tree):
+        paths.add(entry.path)
+    return paths
 
 def arguments_are_in_git_repository(args, origpath):
     # We need to check to make sure that the files/directories that the user is
@@ -1141,7 +3726,8 @@ def arguments_are_in_git_repository(args, origpath):
         if not os.path.realpath(fullpath).startswith(os.getcwd()):
             raise GotException("Argument '%s' is not located in the git repository" % fullpath)
 
-def add_walker(repo, origpath, cb_params, args):
+@profiled('walk.add')
+def add_walker(repo, origpath, cb_params, args, jobs=1):
     """
     A function to walk down a list of files/directories, calling the add_cb for
     each argument.
@@ -1151,42 +3737,143 @@ def add_walker(repo, origpath, cb_params, args):
                         invoked, used to figure out the appropriate paths
     @param cb_params    Callback specific parameters to pass to the callback
     @param args         The list of files/directories to walk
+    @param jobs         How many files to hash, and how many remote requests
+                        to make, at the same time
 
     @return A string built from the output of all invocations of the callback
             function.
     """
     arguments_are_in_git_repository(args, origpath)
 
-    output = []
+    files = []
+    managed = None
+
+    with profiler.span('walk.tree'):
+        for arg in args:
+            fullpath = os.path.normpath(os.path.join(origpath, arg))
+            logging.debug('add_walker: processing argument %s' % fullpath)
+            if os.path.isdir(fullpath):
+                if managed is None:
+                    managed = git_managed_paths(repo)
+                for base, dirs, filenames in os.walk(fullpath):
+                    if '.git' in dirs:
+                        dirs.remove('.git')
+                    if '.got' in dirs:
+                        dirs.remove('.got')
+                    for filename in filenames:
+                        # When we are recursively adding, we don't want to touch any files
+                        # that are already managed by git.
+                        realpath = os.path.normpath(os.path.join(base, filename))
+                        if realpath in managed:
+                            continue
+                        if realpath == MANIFEST_FILE:
+                            continue
+                        gotpath = os.path.normpath(os.path.join(base, "." + filename + ".got"))
+                        files.append((gotpath, realpath))
+            else:
+                # this covers both the case where the argument is a file and the
+                # case where the full path isn't a file at all (which can happen if
+                # the local version of the file was deleted)
+                (base, filename) = os.path.split(fullpath)
+                files.append((os.path.join(base, '.%s.got' % filename), fullpath))
+
+    if len(files) == 0:
+        return []
+    try:
+        remote_obj = find_add_remote(cb_params)
+    except Exception as e:
+        raise GotException("Failed to add: %s" % str(e))
+
+    # Before uploading anything, ask the remote in one go which of the objects
+    # it already has, rather than once per file.  That needs the hashes, so
+    # the files are hashed up front, unless they are to be hashed as they are
+    # uploaded (see add_cb()); then only those already in the hash index are
+    # asked about.
+    unhashed = remote_obj.can_rename and hash_on_upload
+    if not unhashed:
+        hash_files([realpath for (gotpath, realpath) in files], jobs)
+    checksums = []
+    for (gotpath, realpath) in files:
+        try:
+            if unhashed:
+                csum = hash_index.lookup(realpath, stat_key(os.stat(realpath)))
+            else:
+                csum = local_file_hash(realpath)
+        except (IOError, OSError):
+            # add_cb() reports the problem with this file
+            continue
+        if csum is not None:
+            checksums.append(csum)
+    if len(checksums) > 1:
+        present = remote_obj.exists_many(checksums, jobs)
+        logging.debug('add_walker: %d of %d files already on the remote' % (len(present), len(checksums)))
+
+    return run_callbacks(add_cb, repo, cb_params, files)
+
+@profiled('walk.find')
+def find_got_files(repo, origpath, args):
+    """
+    A function to collect the got managed files in a list of
+    files/directories.  The files are found in the manifest, or else from the
+    .got files in the git index, so the cost is in proportion to the number of
+    tracked files rather than to the size of the working tree.
+
+    @param repo         Dulwich repository object
+    @param origpath     The original current working directory when got was
+                        invoked, used to figure out the appropriate paths
+    @param args         The list of files/directories to look in
+
+    @return A list of (got_filename, real_filename) tuples, sorted by path
+            for each argument.
+    """
+    files = []
+
+    arguments_are_in_git_repository(args, origpath)
+
+    if manifest is None:
+        got_files = sorted(path for path in repo.open_index()
+                           if fnmatch.fnmatch(os.path.basename(path), '.*.got'))
 
     for arg in args:
         fullpath = os.path.normpath(os.path.join(origpath, arg))
-        logging.debug('add_walker: processing argument %s' % fullpath)
-        if os.path.isdir(fullpath):
-            for base, dirs, filenames in os.walk(fullpath):
-                if '.git' in dirs:
-                    dirs.remove('.git')
-                if '.got' in dirs:
-                    dirs.remove('.got')
-                for filename in filenames:
-                    # When we are recursively adding, we don't want to touch any files
-                    # that are already managed by git.
-                    if file_is_managed_by_git(repo, os.path.normpath(os.path.join(base, filename))):
-                        continue
-                    realpath = os.path.normpath(os.path.join(base, filename))
-                    gotpath = os.path.normpath(os.path.join(base, "." + filename + ".got"))
-                    logging.debug('add_walker: processing file %s' % realpath)
-                    output.append(add_cb(repo, gotpath, realpath, cb_params))
+        logging.debug('walker: processing argument %s' % fullpath)
+        if manifest is not None:
+            # the manifest knows the files under a directory, even one that
+            # is gone locally
+            if manifest.get(fullpath) is not None:
+                realpaths = [fullpath]
+            else:
+                realpaths = manifest.paths(fullpath)
+                if len(realpaths) == 0 and not os.path.isdir(fullpath):
+                    # not tracked; the callback reports that
+                    realpaths = [fullpath]
+            for realpath in realpaths:
+                (base, filename) = os.path.split(realpath)
+                files.append((os.path.join(base, '.%s.got' % filename), realpath))
+        elif os.path.isdir(fullpath):
+            if fullpath == '.':
+                found = got_files
+            else:
+                # every path under "fullpath/" sorts between these
+                start = bisect.bisect_left(got_files, fullpath + '/')
+                end = bisect.bisect_left(got_files, fullpath + chr(ord('/') + 1), start)
+                found = got_files[start:end]
+            for gotpath in found:
+                # the index still lists a .got file deleted from the working
+                # tree until the deletion is staged; that file isn't tracked
+                if not os.path.isfile(gotpath):
+                    logging.debug("walker: skipping '%s', which is in the git index but not in the working tree" % gotpath)
+                    continue
+                files.append((gotpath, got_file_target(gotpath)))
         else:
             # this covers both the case where the argument is a file and the
             # case where the full path isn't a file at all (which can happen if
             # the local version of the file was deleted)
-            logging.debug('add_walker: processing file %s' % fullpath)
             (base, filename) = os.path.split(fullpath)
-            output.append(add_cb(repo, os.path.join(base, '.%s.got' % filename), fullpath, cb_params))
-    return output
+            files.append((os.path.join(base, '.%s.got' % filename), fullpath))
+    return files
 
-def walker(function, repo, origpath, cb_params, args):
+def walker(function, repo, origpath, cb_params, args, jobs=1):
     """
     A function to walk down a list of files/directories, calling a callback on
     each one.  The callback is expected to have a signature of:
@@ -1199,35 +3886,64 @@ def walker(function, repo, origpath, cb_params, args):
                         invoked, used to figure out the appropriate paths
     @param cb_params    Callback specific parameters to pass to the callback
     @param args         The list of files/directories to walk
+    @param jobs         How many callbacks to run at the same time; defaults
+                        to 1
 
     @return A string built from the output of all invocations of the callback
             function.
     """
-    output = []
+    return run_callbacks(function, repo, cb_params,
+                         find_got_files(repo, origpath, args), jobs)
 
-    arguments_are_in_git_repository(args, origpath)
+@profiled('walk.callbacks')
+def run_callbacks(function, repo, cb_params, files, jobs=1):
+    """
+    A function to call a walker callback on each of a list of got managed
+    files.
+
+    @param function     The function to call on each got managed file
+    @param repo         Dulwich repository object to pass into the callback
+    @param cb_params    Callback specific parameters to pass to the callback
+    @param files        The list of (got_filename, real_filename) tuples, as
+                        returned by find_got_files()
+    @param jobs         How many callbacks to run at the same time; defaults
+                        to 1.  A failing callback does not stop the others;
+                        all of the failures are reported together, by a
+                        CallbackErrors, once every file has been processed.
+
+    @return A list of the output of all invocations of the callback function,
+            in the same order as the files.
+    """
+    def run_one(entry):
+        (gotpath, realpath) = entry
+        logging.debug('walker: processing file %s' % realpath)
+        try:
+            return (function(repo, gotpath, realpath, cb_params), None)
+        except GotException as e:
+            return (None, e)
+        except Exception as e:
+            return (None, GotException("Failed to process '%s': %s" % (realpath, str(e))))
+
+    if jobs <= 1 or len(files) <= 1:
+        results = [run_one(entry) for entry in files]
+    else:
+        pool = multiprocessing.pool.ThreadPool(min(jobs, len(files)))
+        try:
+            # map_async().get() with a timeout (rather than a plain map()) so
+            # that a Ctrl-C is delivered to us while we wait on the workers
+            results = pool.map_async(run_one, files).get(sys.maxint)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    output = [out for (out, e) in results]
+    errors = [e for (out, e) in results if e is not None]
+    if len(errors) == 1 and len(files) == 1:
+        raise errors[0]
+    if len(errors) != 0:
+        raise CallbackErrors("%d of %d files failed:\n\n  " % (len(errors), len(files)) +
+                             "\n  ".join(str(e) for e in errors), output)
 
-    for arg in args:
-        fullpath = os.path.normpath(os.path.join(origpath, arg))
-        logging.debug('walker: processing argument %s' % fullpath)
-        if os.path.isdir(fullpath):
-            for base, dirs, filenames in os.walk(fullpath):
-                if '.git' in dirs:
-                    dirs.remove('.git')
-                if '.got' in dirs:
-                    dirs.remove('.got')
-                for filename in fnmatch.filter(filenames, '.*.got'):
-                    realpath = os.path.normpath(os.path.join(base, filename[1:-4]))
-                    gotpath = os.path.normpath(os.path.join(base, filename))
-                    logging.debug('walker: processing file %s' % realpath)
-                    output.append(function(repo, gotpath, realpath, cb_params))
-        else:
-            # this covers both the case where the argument is a file and the
-            # case where the full path isn't a file at all (which can happen if
-            # the local version of the file was deleted)
-            logging.debug('walker: processing file %s' % fullpath)
-            (base, filename) = os.path.split(fullpath)
-            output.append(function(repo, os.path.join(base, '.%s.got' % filename), fullpath, cb_params))
     return output
 
 ############################## MAIN HELPERS ##################################
@@ -1247,10 +3963,16 @@ def parse_opts(argv):
     verbose = False
     force = False
     recurse = False
+    jobs = 1
+    profile = False
+    profile_trace = None
     try:
-        opts, args = getopt.gnu_getopt(argv[1:], 'd:fhRr:v', ['debug', 'force',
-                                                              'help', 'remote',
-                                                              'recurse', 'verbose'])
+        opts, args = getopt.gnu_getopt(argv[1:], 'd:fhj:Rr:v', ['debug', 'force',
+                                                                'help', 'jobs=',
+                                                                'profile',
+                                                                'profile-trace=',
+                                                                'remote',
+                                                                'recurse', 'verbose'])
     except getopt.GetoptError as err:
         raise GotException(str(err), need_usage=True)
 
@@ -1276,6 +3998,19 @@ def parse_opts(argv):
             force = True
         elif o in ("-h", "--help"):
             help_requested = True
+        elif o in ("-j", "--jobs"):
+            try:
+                jobs = int(a)
+            except ValueError:
+                raise GotException("Invalid number of jobs '%s'" % a, need_usage=True)
+            if jobs < 1:
+                raise GotException("Invalid number of jobs '%s'" % a, need_usage=True)
+        elif o == "--profile":
+            profile = True
+        elif o == "--profile-trace":
+            profile = True
+            # before we change directory to the top of the repository
+            profile_trace = os.path.abspath(a)
         elif o in ("-R", "--recurse"):
             recurse = True
         elif o in ("-r", "--remote"):
@@ -1285,7 +4020,101 @@ def parse_opts(argv):
         else:
             raise GotException("unhandled option '%s'" % o)
 
-    return (args, loglevel, logformat, remote, help_requested, verbose, force, recurse)
+    return (args, loglevel, logformat, remote, help_requested, verbose, force, recurse, jobs, profile, profile_trace)
+
+def get_setting(config, name, default):
+    """
+    Look up a got setting in the git configuration.
+
+    @param config   The dulwich configuration stack
+    @param name     The name of the setting in the "got" section
+    @param default  The value to use if the setting is not configured
+    @return The value of the setting
+    """
+    try:
+        # dulwich stores the names lowercased, just like git matches them
+        return config.get(('got',), name.lower())
+    except KeyError:
+        return default
+
+def load_settings(repo):
+    """
+    Read the got settings from the git configuration: the repository's own,
+    then the user's (~/.gitconfig), then the system's (/etc/gitconfig).  The
+    supported settings are:
+
+    got.cacheDir           Where the local cache is; ~/.git-got-cache by
+                           default.  Several jobs and users can share one
+                           cache; for users, make it writable and setgid
+                           for a group they are in.
+    got.cacheLink          How files are brought out of the local cache;
+                           one of 'copy', 'reflink' (the default) or
+                           'hardlink'
+    got.cacheMaxSize       The most the local cache may hold, e.g. "20G";
+                           unlimited by default
+    got.cacheLowWatermark  How full, in percent of got.cacheMaxSize, to
+                           leave the cache when it has to be shrunk; 80 by
+                           default
+    got.segmentThreshold   How big an object must be, e.g. "64M" (the
+                           default), to be downloaded from an HTTP remote,
+                           or uploaded over SCP, in several pieces at the
+                           same time
+    got.segments           How many pieces to transfer such an object in;
+                           4 by default, 1 turns it off
+    got.hashOnUpload       Whether add hashes files as they are uploaded,
+                           reading each file once instead of twice, at the
+                           cost of uploading files the remote already has;
+                           false by default
+
+    @param repo  Dulwich repository object
+    """
+    global local_cache_path, cache_link_mode, cache_max_size, cache_low_watermark
+    global segment_threshold, transfer_segments, hash_on_upload
+    config = repo.get_config_stack()
+
+    local_cache_path = os.path.expanduser(get_setting(config, 'cacheDir', local_cache_path))
+
+    mode = get_setting(config, 'cacheLink', cache_link_mode)
+    if mode not in CACHE_LINK_MODES:
+        raise GotException("Invalid got.cacheLink '%s'; it must be one of %s" % (mode, ", ".join(CACHE_LINK_MODES)))
+    cache_link_mode = mode
+
+    max_size = get_setting(config, 'cacheMaxSize', None)
+    if max_size is not None:
+        cache_max_size = parse_size(max_size)
+
+    low_watermark = get_setting(config, 'cacheLowWatermark', None)
+    if low_watermark is not None:
+        try:
+            cache_low_watermark = int(low_watermark)
+        except ValueError:
+            cache_low_watermark = -1
+        if not 0 <= cache_low_watermark <= 100:
+            raise GotException("Invalid got.cacheLowWatermark '%s'; it must be a percentage" % low_watermark)
+
+    threshold = get_setting(config, 'segmentThreshold', None)
+    if threshold is not None:
+        segment_threshold = parse_size(threshold)
+        if segment_threshold == 0:
+            raise GotException("Invalid got.segmentThreshold '%s'; it must be more than 0" % threshold)
+
+    segments = get_setting(config, 'segments', None)
+    if segments is not None:
+        try:
+            transfer_segments = int(segments)
+        except ValueError:
+            transfer_segments = 0
+        if transfer_segments < 1:
+            raise GotException("Invalid got.segments '%s'; it must be a positive number" % segments)
+
+    on_upload = get_setting(config, 'hashOnUpload', None)
+    if on_upload is not None:
+        if on_upload.lower() in ('true', 'yes', 'on', '1'):
+            hash_on_upload = True
+        elif on_upload.lower() in ('false', 'no', 'off', '0'):
+            hash_on_upload = False
+        else:
+            raise GotException("Invalid got.hashOnUpload '%s'; it must be true or false" % on_upload)
 
 def find_git_path_and_chdir():
     """
@@ -1317,6 +4146,7 @@ def find_git_path_and_chdir():
     except Exception as e:
         raise GotException("Failed to initialize git-got: %s" % (str(e)))
 
+@profiled('remotes.load')
 def check_initialized():
     """
     Function to look for got initialization, and open up the configuration if
@@ -1388,18 +4218,37 @@ def add_remote(args, default, repo):
     configuration = { 'remote' : remote , 'remote_type' : remote_type , 'version' : VERSION, 'name': name, 'default': default }
     with open(filename, 'ab') as storagefile:
         json.dump(configuration, storagefile)
-    dulwich.porcelain.add(repo, filename)
+    git_stage.add(filename)
 
-def upgrade_command(args):
+def upgrade_command(args, repo, origpath):
     """
-    Run the upgrade command.  This is not yet implemented.
+    Run the upgrade command, which moves the tracking information of every
+    file from its .got file into a manifest (see Manifest).
 
-    @param args  The non-option arguments to this command
+    @param args      The non-option arguments to this command
+    @param repo      Dulwich repository object
+    @param origpath  The original path that git-got was started in
     """
+    global manifest
     if len(args) != 1:
         raise GotException("", need_usage=True)
 
-def add_command(args, recurse, repo, origpath, remote):
+    if manifest is not None:
+        print("Already using the manifest '%s'" % MANIFEST_FILE)
+        return
+
+    files = find_got_files(repo, '', ['.'])
+    new_manifest = Manifest(MANIFEST_FILE, create=True)
+    for (gotpath, realpath) in files:
+        new_manifest.set(realpath, read_got_file(gotpath))
+    new_manifest.save(repo)
+
+    for (gotpath, realpath) in files:
+        remove_got_file(repo, gotpath)
+    manifest = new_manifest
+    print("Moved the tracking information of %d files into '%s'" % (len(files), MANIFEST_FILE))
+
+def add_command(args, recurse, repo, origpath, remote, jobs):
     """
     Run the add command to add a file to git-got tracking.  Addition of
     subdirectories is not allowed.
@@ -1409,6 +4258,7 @@ def add_command(args, recurse, repo, origpath, remote):
     @param repo      Dulwich repository object
     @param origpath  The original path that git-got was started in
     @param remote    The remote to add this file to (maybe None, which means use the default)
+    @param jobs      How many files to hash, and remote requests to make, at the same time
     """
     if len(args) < 2:
         raise GotException("Not enough arguments to add command", need_usage=True)
@@ -1419,7 +4269,39 @@ def add_command(args, recurse, repo, origpath, remote):
             if os.path.isdir(os.path.join(origpath, arg)):
                 raise GotException("Got only allows files, not subdirectories, to be added")
 
-        add_walker(repo, origpath, remote, args[1:])
+    add_walker(repo, origpath, remote, args[1:], jobs)
+
+def prepare_get(files, force, jobs):
+    """
+    Tell each remote up front which objects a get is going to fetch from it,
+    so that it can look them all up at once before the downloads start.
+    Files that are up to date or in the local cache are left out.
+
+    @param files     The list of (got_filename, real_filename) tuples to get
+    @param force     Whether the transfer is forced or not
+    @param jobs      How many files will be fetched at the same time
+    """
+    wanted = {}
+    for (gotpath, realpath) in files:
+        try:
+            gotconf = read_got_file(gotpath)
+        except (IOError, ValueError):
+            gotconf = None
+        if gotconf is None:
+            # get_cb() reports the problem with this file
+            continue
+
+        if not force and status_local(realpath, gotconf['sha-256']):
+            continue
+        wanted.setdefault(gotconf['remote'], []).append(gotconf['sha-256'])
+
+    for remote_obj in remote_objs:
+        checksums = wanted.get(remote_obj.remote_name(), [])
+        if not force:
+            checksums = [c for c in checksums
+                         if not os.path.isfile(remote_obj.generate_path_for_cache(c))]
+        if len(checksums) != 0:
+            remote_obj.prepare_load(checksums, jobs)
 
 def reset_command(args, repo, origpath):
     """
@@ -1440,7 +4322,7 @@ def reset_command(args, repo, origpath):
 
     walker(reset_cb, repo, origpath, None, args[1:])
 
-def get_command(args, force, repo, origpath):
+def get_command(args, force, repo, origpath, jobs):
     """
     Run the get command to fetch git-got tracked file(s) to the local directory.
     If parameters are given, only the given files are fetched.  If no parameters
@@ -1448,8 +4330,10 @@ def get_command(args, force, repo, origpath):
     files that need to be fetched are actually fetched.
 
     @param args      The non-option arguments to this command
+    @param force     Whether to force the transfer or not
     @param repo      Dulwich repository object
     @param origpath  The original path that git-got was started in
+    @param jobs      How many files to fetch at the same time
     """
     if len(args) == 1:
         path = ['.']
@@ -1458,15 +4342,22 @@ def get_command(args, force, repo, origpath):
     else:
         raise GotException("Not enough arguments to get command", need_usage=True)
 
-    walker(get_cb, repo, origpath, force, path)
+    files = find_got_files(repo, origpath, path)
+    if not force:
+        hash_files([realpath for (gotpath, realpath) in files], jobs)
+    prepare_get(files, force, jobs)
+    run_callbacks(get_cb, repo, force, files, jobs)
+    partial_gc()
 
-def status_command(args, repo, origpath, verbose):
+def status_command(args, repo, origpath, verbose, jobs):
     """
     Run the status command to get the status of git-got tracked files.
 
     @param args      The non-option arguments to this command
     @param repo      Dulwich repository object
     @param origpath  The original path that git-got was started in
+    @param verbose   Whether to list unmodified files too
+    @param jobs      How many files to hash at the same time
     """
     if len(args) == 1:
         path = ['.']
@@ -1475,12 +4366,21 @@ def status_command(args, repo, origpath, verbose):
     else:
         raise GotException("Not enough arguments to status command", need_usage=True)
 
-    changes = walker(status_cb, repo, origpath, verbose, path)
+    files = find_got_files(repo, origpath, path)
+    hash_files([realpath for (gotpath, realpath) in files], jobs)
+    try:
+        changes = run_callbacks(status_cb, repo, verbose, files)
+        failed = None
+    except CallbackErrors as e:
+        # still show the status of the files that didn't fail
+        (changes, failed) = (e.output, e)
 
     print('# Changes')
     for change in changes:
         if None != change:
             print('# %s' % change)
+    if failed is not None:
+        raise failed
 
 def rm_command(args, recurse, repo, origpath):
     """
@@ -1544,16 +4444,14 @@ def remove_remote_command(args, repo, origpath):
 
     # OK, there are no links to this remote.  We can remove it
     fullpath = os.path.join(".got", remote_obj.remote_name())
-    if fullpath in dulwich.porcelain.status(repo).staged['add']:
+    if git_stage.is_staged_add(fullpath):
         # In theory we should use dulwich.porcelain.rm() here, but for some
         # reason it doesn't seem to work.  This is basically the same thing.
-        index = repo.open_index()
-        del index[fullpath]
-        index.write()
+        git_stage.remove(fullpath)
         os.remove(fullpath)
     else:
         os.remove(fullpath)
-        dulwich.porcelain.add(repo, fullpath)
+        git_stage.add(fullpath)
 
 def list_remotes_command(args):
     """
@@ -1626,7 +4524,69 @@ def clear_local_cache_command():
         raise GotException("Failed to clear cache")
     print("Cleared local cache")
 
-def fill_local_cache_command(args, repo, origpath):
+def cache_gc_command(args):
+    """
+    Run the cache-gc command to shrink the local cache down to its configured
+    size.
+
+    @param args      The non-option arguments to this command
+    """
+    if len(args) == 1:
+        if cache_max_size is None:
+            raise GotException("No size given, and got.cacheMaxSize is not configured")
+        max_size = cache_max_size
+    elif len(args) == 2:
+        max_size = parse_size(args[1])
+    else:
+        raise GotException("Invalid number of arguments to cache-gc command", need_usage=True)
+
+    (removed, freed, left) = cache_gc(max_size, cache_low_watermark)
+    print("Removed %d objects (%s) from the local cache; %s left" % (removed,
+                                                                    format_size(freed),
+                                                                    format_size(left)))
+
+def stats_command(args, origpath):
+    """
+    Run the stats command to show the counters kept by UsageStats, or to write
+    them out for Prometheus.
+
+    @param args      The non-option arguments to this command
+    @param origpath  The original path that git-got was started in
+    """
+    if len(args) > 2:
+        raise GotException("Invalid number of arguments to stats command", need_usage=True)
+
+    (counters, remotes) = usage_stats.load()
+
+    if len(args) == 2:
+        # node_exporter's textfile collector may read the file at any time, so
+        # it must never see it half written
+        filename = os.path.join(origpath, args[1])
+        tmp = temp_path(filename)
+        with open(tmp, 'wb') as fp:
+            fp.write(prometheus_text(counters, remotes))
+        os.rename(tmp, filename)
+        return
+
+    lookups = counters.get('cache_lookups', 0)
+    hits = counters.get('cache_hits', 0)
+    if lookups == 0:
+        print("Local cache: no lookups yet")
+    else:
+        print("Local cache: %d of %d lookups hit (%.1f%%), %s served" % (hits, lookups,
+                                                                        hits * 100.0 / lookups,
+                                                                        format_size(counters.get('cache_hit_bytes', 0))))
+    for remote in sorted(remotes):
+        c = remotes[remote]
+        print("Remote '%s':" % remote)
+        print("  downloaded %d objects (%s)" % (c.get('download_objects', 0),
+                                                format_size(c.get('download_bytes', 0))))
+        print("  uploaded %d objects (%s)" % (c.get('upload_objects', 0),
+                                              format_size(c.get('upload_bytes', 0))))
+        print("  skipped %d uploads (%s) already on the remote" % (c.get('upload_skipped_objects', 0),
+                                                                   format_size(c.get('upload_skipped_bytes', 0))))
+
+def fill_local_cache_command(args, repo, origpath, jobs):
     """
     Run the fill_local_cache command to add to the local cache the files the
     current project already have checked in.
@@ -1634,6 +4594,7 @@ def fill_local_cache_command(args, repo, origpath):
     @param args      The non-option arguments to this command
     @param repo      Dulwich repository object
     @param origpath  The original path that git-got was started in
+    @param jobs      How many files to process at the same time
     """
     print("Filling current cache")
 
@@ -1644,18 +4605,35 @@ def fill_local_cache_command(args, repo, origpath):
     else:
         raise GotException("Not enough arguments to status command", need_usage=True)
 
-    changes = walker(fill_local_cache_cb, repo, origpath, [], path)
+    files = find_got_files(repo, origpath, path)
+    hash_files([realpath for (gotpath, realpath) in files], jobs)
+    try:
+        changes = run_callbacks(fill_local_cache_cb, repo, [], files, jobs)
+        failed = None
+    except CallbackErrors as e:
+        # still show what happened to the files that didn't fail
+        (changes, failed) = (e.output, e)
 
     print('# Cache status')
     for change in changes:
         if None != change:
             print('# %s' % change)
+    if failed is not None:
+        raise failed
+    partial_gc()
 
 ############################### MAIN ##########################################
 def _main(argv):
+    global hash_index
+    global partial_dir
+    global manifest
+    global git_stage
+    global usage_stats
     loglevel = logging.ERROR
     try:
-        (args, loglevel, logformat, remote, help_requested, verbose, force, recurse) = parse_opts(argv)
+        (args, loglevel, logformat, remote, help_requested, verbose, force, recurse, jobs, profile, profile_trace) = parse_opts(argv)
+        if profile:
+            profiler.enable()
 
         if help_requested:
             print(usage())
@@ -1666,11 +4644,19 @@ def _main(argv):
 
         logging.basicConfig(level=loglevel, format=logformat)
 
-        mkdir_p(local_cache_path)
-
         origpath = find_git_path_and_chdir()
 
-        repo = dulwich.porcelain.open_repo(".")
+        with profiler.span('git.open'):
+            repo = dulwich.repo.Repo(".")
+        git_stage = GitStage(repo)
+
+        hash_index = HashIndex(os.path.join(repo.controldir(), 'got', 'index'))
+        partial_dir = os.path.join(repo.controldir(), 'got', 'partial')
+        usage_stats = UsageStats(os.path.join(repo.controldir(), 'got', 'stats'))
+
+        load_settings(repo)
+
+        mkdir_p(local_cache_path)
 
         command = args[0]
 
@@ -1682,6 +4668,11 @@ def _main(argv):
             # the verbose argument only works for status
             raise GotException("", need_usage=True)
 
+        if command not in ('add', 'get', 'status', 'fill-local-cache') and jobs != 1:
+            # the jobs argument only works for add, get, status and
+            # fill-local-cache
+            raise GotException("", need_usage=True)
+
         if command != 'init':
             if not check_initialized():
                 raise GotException('Got not initialized',
@@ -1691,18 +4682,21 @@ def _main(argv):
             if not check_version():
                 raise GotException("Version of got repository requires upgrading, run upgrade command", need_usage=True)
 
+        if os.path.isfile(MANIFEST_FILE):
+            manifest = Manifest(MANIFEST_FILE)
+
         if command == 'init':
             add_remote(args, True, repo)
         elif command == 'upgrade':
-            upgrade_command(args)
+            upgrade_command(args, repo, origpath)
         elif command == 'add':
-            add_command(args, recurse, repo, origpath, remote)
+            add_command(args, recurse, repo, origpath, remote, jobs)
         elif command == 'reset':
             reset_command(args, repo, origpath)
         elif command == 'get':
-            get_command(args, force, repo, origpath)
+            get_command(args, force, repo, origpath, jobs)
         elif command == 'status':
-            status_command(args, repo, origpath, verbose)
+            status_command(args, repo, origpath, verbose, jobs)
         elif command == 'rm':
             rm_command(args, recurse, repo, origpath)
         elif command == "add_remote":
@@ -1720,9 +4714,16 @@ def _main(argv):
         elif command == "clear-local-cache":
             clear_local_cache_command()
         elif command == "fill-local-cache":
-            fill_local_cache_command(args, repo, origpath)
+            fill_local_cache_command(args, repo, origpath, jobs)
+        elif command == "cache-gc":
+            cache_gc_command(args)
+        elif command == "stats":
+            stats_command(args, origpath)
         else:
             raise GotException("", need_usage=True)
+        if manifest is not None:
+            manifest.save(repo)
+        git_stage.flush()
         return 0
     except Exception as e:
         if loglevel == logging.DEBUG:
@@ -1730,6 +4731,36 @@ def _main(argv):
         else:
             print(str(e))
             return 1
+    finally:
+        for remote_obj in remote_objs:
+            remote_obj.close()
+        if cache_grown and cache_max_size is not None:
+            cache_gc(cache_max_size, cache_low_watermark)
+        # whatever got hashed is still valid, even if the command failed
+        hash_index.save()
+        # and whatever got transferred was transferred
+        usage_stats.save()
+        if manifest is not None and manifest.dirty:
+            # a command that failed part way may have changed the tracking
+            # of some of the files already, as it would have their .got files
+            try:
+                manifest.save(repo)
+            except Exception as e:
+                print("Failed to write '%s': %s" % (MANIFEST_FILE, e))
+        if git_stage.dirty:
+            # likewise for the changes to the index and .gitignore
+            try:
+                git_stage.flush()
+            except Exception as e:
+                print("Failed to update the git index: %s" % e)
+        if profiler.enabled:
+            sys.stderr.write(profiler.summary() + "\n")
+            if profile_trace is not None:
+                try:
+                    with open(profile_trace, 'wb') as fp:
+                        json.dump(profiler.trace(), fp)
+                except (IOError, OSError) as e:
+                    print("Failed to write the profile trace '%s': %s" % (profile_trace, e))
 
 def main():
     exit(_main(sys.argv))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import sys
+import json
+import shutil
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import git_got
+
+class TestHashIndex(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp(prefix='TestHashIndex-')
+    self.path = os.path.join(self.tmpdir, 'hash-index')
+    # a whole second, so that mtimes compare exactly after the JSON round trip
+    self.written = int(time.time()) - 100
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def writeIndex(self, entries):
+    with open(self.path, 'wb') as fp:
+      json.dump({'version': git_got.HashIndex.FORMAT_VERSION, 'entries': entries}, fp)
+    os.utime(self.path, (self.written, self.written))
+
+  def key(self, mtime):
+    return (1234, mtime, 42, mtime)
+
+  def testOlderEntryIsTrusted(self):
+    mtime = self.written - 10
+    self.writeIndex({'old': list(self.key(mtime)) + ['aaa']})
+    index = git_got.HashIndex(self.path)
+    self.assertEqual(index.lookup('old', self.key(mtime)), 'aaa')
+
+  def testChangedStatIsNotTrusted(self):
+    mtime = self.written - 10
+    self.writeIndex({'old': list(self.key(mtime)) + ['aaa']})
+    index = git_got.HashIndex(self.path)
+    self.assertEqual(index.lookup('old', (1235, mtime, 42, mtime)), None)
+
+  def testRacilyCleanEntryIsIgnored(self):
+    # modified in the same instant the index was written
+    self.writeIndex({'racy': list(self.key(self.written)) + ['bbb']})
+    index = git_got.HashIndex(self.path)
+    self.assertEqual(index.lookup('racy', self.key(self.written)), None)
+
+  def testNewerEntryIsIgnored(self):
+    mtime = self.written + 5
+    self.writeIndex({'newer': list(self.key(mtime)) + ['ccc']})
+    index = git_got.HashIndex(self.path)
+    self.assertEqual(index.lookup('newer', self.key(mtime)), None)
+
+  def testOtherVersionIsIgnored(self):
+    mtime = self.written - 10
+    with open(self.path, 'wb') as fp:
+      json.dump({'version': git_got.HashIndex.FORMAT_VERSION + 1,
+                 'entries': {'old': list(self.key(mtime)) + ['aaa']}}, fp)
+    os.utime(self.path, (self.written, self.written))
+    index = git_got.HashIndex(self.path)
+    self.assertEqual(index.lookup('old', self.key(mtime)), None)
+
+  def testSaveAndLoad(self):
+    mtime = self.written - 10
+    index = git_got.HashIndex(self.path)
+    index.record('a', self.key(mtime), 'aaa')
+    index.record('b', self.key(mtime), 'bbb')
+    index.forget('b')
+    index.save()
+    index = git_got.HashIndex(self.path)
+    self.assertEqual(index.lookup('a', self.key(mtime)), 'aaa')
+    self.assertEqual(index.lookup('b', self.key(mtime)), None)
+
+if __name__ == '__main__':
+  unittest.main()
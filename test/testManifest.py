@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import git_got
+
+def gotconf(digest, mode=0100644, remote='origin'):
+  return {'sha-256': digest, 'mode': mode, 'remote': remote}
+
+class TestManifest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp(prefix='TestManifest-')
+    self.path = os.path.join(self.tmpdir, git_got.MANIFEST_FILE)
+    # save() stages the manifest; with no repository that is a no-op
+    git_got.git_stage = git_got.GitStage(None)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def reload(self, manifest):
+    manifest.save(None)
+    return git_got.Manifest(self.path)
+
+  def testRoundTrip(self):
+    paths = ['plain', 'with\ttab', 'with\nnewline', 'with\\backslash',
+             'with\\ttab-lookalike', 'dir/with\\\n\tall']
+    manifest = git_got.Manifest(self.path, create=True)
+    for (i, path) in enumerate(paths):
+      manifest.set(path, gotconf('%064x' % i, 0100755 if i % 2 else 0100644))
+    manifest = self.reload(manifest)
+    for (i, path) in enumerate(paths):
+      self.assertEqual(manifest.get(path),
+                       gotconf('%064x' % i, 0100755 if i % 2 else 0100644))
+    self.assertEqual(sorted(manifest.paths('.')), sorted(paths))
+    # the header, and one line per file
+    with open(self.path, 'rb') as fp:
+      self.assertEqual(len(fp.read().split('\n')), len(paths) + 2)
+
+  def testSetReplacesAndRemove(self):
+    manifest = git_got.Manifest(self.path, create=True)
+    manifest.set('a', gotconf('1' * 64))
+    manifest.set('a', gotconf('2' * 64, remote='other'))
+    manifest.set('b', gotconf('3' * 64))
+    self.assertTrue(manifest.remove('b'))
+    self.assertFalse(manifest.remove('b'))
+    manifest = self.reload(manifest)
+    self.assertEqual(manifest.get('a'), gotconf('2' * 64, remote='other'))
+    self.assertEqual(manifest.get('b'), None)
+    self.assertEqual(manifest.paths('.'), ['a'])
+
+  def testPathsAtDirectoryBoundaries(self):
+    # '-' and '.' sort before '/', and '0' right after it
+    paths = ['a', 'a-b/x', 'a.b', 'a/sub/y', 'a/x', 'a/with\ttab', 'a0/z', 'ab', 'b/a/x']
+    manifest = git_got.Manifest(self.path, create=True)
+    for path in paths:
+      manifest.set(path, gotconf('0' * 64))
+    manifest = self.reload(manifest)
+    self.assertEqual(sorted(manifest.paths('a')), ['a/sub/y', 'a/with\ttab', 'a/x'])
+    self.assertEqual(sorted(manifest.paths('a/')), ['a/sub/y', 'a/with\ttab', 'a/x'])
+    self.assertEqual(manifest.paths('a/sub'), ['a/sub/y'])
+    self.assertEqual(manifest.paths('a-b'), ['a-b/x'])
+    self.assertEqual(manifest.paths('a0'), ['a0/z'])
+    self.assertEqual(manifest.paths('b'), ['b/a/x'])
+    self.assertEqual(manifest.paths('c'), [])
+    self.assertEqual(manifest.paths('a/x'), [])
+    self.assertEqual(sorted(manifest.paths('.')), sorted(paths))
+
+  def testNewerVersionIsRefused(self):
+    with open(self.path, 'wb') as fp:
+      fp.write('%s %d\n' % (git_got.Manifest.HEADER, git_got.Manifest.FORMAT_VERSION + 1))
+    manifest = git_got.Manifest(self.path)
+    self.assertRaises(git_got.GotException, manifest.get, 'a')
+
+if __name__ == '__main__':
+  unittest.main()
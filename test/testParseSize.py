@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import git_got
+
+class TestParseSize(unittest.TestCase):
+  def testPlainNumber(self):
+    self.assertEqual(git_got.parse_size('0'), 0)
+    self.assertEqual(git_got.parse_size('500'), 500)
+    self.assertEqual(git_got.parse_size(' 500 '), 500)
+
+  def testSuffixes(self):
+    self.assertEqual(git_got.parse_size('1k'), 1024)
+    self.assertEqual(git_got.parse_size('2M'), 2 * 1024 ** 2)
+    self.assertEqual(git_got.parse_size('20G'), 20 * 1024 ** 3)
+    self.assertEqual(git_got.parse_size('3t'), 3 * 1024 ** 4)
+
+  def testByteSuffix(self):
+    self.assertEqual(git_got.parse_size('100b'), 100)
+    self.assertEqual(git_got.parse_size('2MB'), 2 * 1024 ** 2)
+    self.assertEqual(git_got.parse_size('20gb'), 20 * 1024 ** 3)
+
+  def testFraction(self):
+    self.assertEqual(git_got.parse_size('1.5M'), 1536 * 1024)
+    self.assertEqual(git_got.parse_size('0.5k'), 512)
+
+  def testInvalid(self):
+    for text in ('', 'k', 'MB', 'abc', '1x', '1kk', '-1', '-1k', 'nan', 'inf', '1e400'):
+      with self.assertRaises(git_got.GotException) as cm:
+        git_got.parse_size(text)
+      self.assertIn("'%s'" % text, str(cm.exception))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import git_got
+
+class TestPrometheusText(unittest.TestCase):
+  def testCounters(self):
+    text = git_got.prometheus_text({'cache_hits': 3, 'cache_hit_bytes': 4096}, {})
+    lines = text.split('\n')
+    self.assertTrue(text.endswith('\n'))
+    self.assertIn('git_got_cache_hits_total 3', lines)
+    self.assertIn('git_got_cache_hit_bytes_total 4096', lines)
+    # counters never counted are there too, at 0
+    self.assertIn('git_got_cache_lookups_total 0', lines)
+    self.assertIn('# TYPE git_got_cache_hits_total counter', lines)
+    self.assertIn('# HELP git_got_cache_hits_total Objects found in the local cache.', lines)
+
+  def testRemoteCounters(self):
+    text = git_got.prometheus_text({}, {'origin': {'download_bytes': 10},
+                                        'backup': {'upload_objects': 2}})
+    lines = text.split('\n')
+    self.assertIn('git_got_download_bytes_total{remote="origin"} 10', lines)
+    self.assertIn('git_got_download_bytes_total{remote="backup"} 0', lines)
+    self.assertIn('git_got_upload_objects_total{remote="backup"} 2', lines)
+    # remotes in a stable order
+    self.assertLess(lines.index('git_got_download_bytes_total{remote="backup"} 0'),
+                    lines.index('git_got_download_bytes_total{remote="origin"} 10'))
+    # each metric described once, however many remotes there are
+    self.assertEqual(lines.count('# TYPE git_got_download_bytes_total counter'), 1)
+
+  def testLabelEscaping(self):
+    text = git_got.prometheus_text({}, {'a"b\\c\nd': {'upload_bytes': 1}})
+    self.assertIn('git_got_upload_bytes_total{remote="a\\"b\\\\c\\nd"} 1', text.split('\n'))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import sys
+import hashlib
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import git_got
+
+class TestUsageStats(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp(prefix='TestUsageStats-')
+    self.store = os.path.join(self.tmpdir, 'store')
+    os.mkdir(self.store)
+    self.cache = os.path.join(self.tmpdir, 'cache')
+    self.saved = (git_got.local_cache_path, git_got.usage_stats, git_got.partial_dir)
+    git_got.local_cache_path = self.cache
+    git_got.partial_dir = None
+    git_got.usage_stats = git_got.UsageStats(os.path.join(self.tmpdir, 'stats'))
+    self.data = os.urandom(100000)
+    self.checksum = hashlib.sha256(self.data).hexdigest()
+
+  def tearDown(self):
+    (git_got.local_cache_path, git_got.usage_stats, git_got.partial_dir) = self.saved
+    shutil.rmtree(self.tmpdir)
+
+  def remote(self):
+    # a new remote object knows nothing of what the remote has, as in a new
+    # command
+    return git_got.File({'name': 'origin', 'remote_type': 'file',
+                         'remote': 'file://' + self.store, 'version': 1})
+
+  def writeFile(self, name):
+    path = os.path.join(self.tmpdir, name)
+    with open(path, 'wb') as fp:
+      fp.write(self.data)
+    return path
+
+  def stored(self):
+    git_got.usage_stats.save()
+    return git_got.usage_stats.load()
+
+  def testStoreUnhashedCountsSkippedUploads(self):
+    path = self.writeFile('a')
+    self.assertEqual(self.remote().store_unhashed(path), self.checksum)
+    # the remote has it already, so the second upload is dropped
+    self.assertEqual(self.remote().store_unhashed(path), self.checksum)
+    (counters, remotes) = self.stored()
+    self.assertEqual(remotes['origin'], {'upload_objects': 1,
+                                         'upload_bytes': len(self.data),
+                                         'upload_skipped_objects': 1,
+                                         'upload_skipped_bytes': len(self.data)})
+
+  def testStoreCountsSkippedUploads(self):
+    path = self.writeFile('a')
+    self.remote().store(path, self.checksum)
+    self.remote().store(path, self.checksum)
+    (counters, remotes) = self.stored()
+    self.assertEqual(remotes['origin'], {'upload_objects': 1,
+                                         'upload_bytes': len(self.data),
+                                         'upload_skipped_objects': 1,
+                                         'upload_skipped_bytes': len(self.data)})
+
+  def testLoadCountsDownloadsAndCacheHits(self):
+    self.remote().store(self.writeFile('a'), self.checksum)
+    # empty the cache, so that the first load downloads the object
+    shutil.rmtree(self.cache)
+    self.remote().load(os.path.join(self.tmpdir, 'b'), self.checksum, False)
+    self.remote().load(os.path.join(self.tmpdir, 'c'), self.checksum, False)
+    (counters, remotes) = self.stored()
+    self.assertEqual(counters, {'cache_lookups': 2, 'cache_hits': 1,
+                                'cache_hit_bytes': len(self.data)})
+    self.assertEqual(remotes['origin']['download_objects'], 1)
+    self.assertEqual(remotes['origin']['download_bytes'], len(self.data))
+
+  def testSaveAddsToStoredCounters(self):
+    git_got.usage_stats.add('cache_hits', 2)
+    git_got.usage_stats.add('upload_objects', 1, 'origin')
+    git_got.usage_stats.save()
+    git_got.usage_stats.add('cache_hits', 3)
+    (counters, remotes) = self.stored()
+    self.assertEqual(counters, {'cache_hits': 5})
+    self.assertEqual(remotes, {'origin': {'upload_objects': 1}})
+
+if __name__ == '__main__':
+  unittest.main()